@@ -0,0 +1,151 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""arena -- Preprocessed rules text of the whole corpus in one mapped file.
+
+The file holds a small JSON header (the card names and a key identifying
+the text, eg. cluster.corpus_key of the cards), then two tables of unsigned
+32-bit integers, then all the lines of text, UTF-8 encoded, back to back:
+    cards: for card i, its lines are lines[cards[i]:cards[i+1]].
+    lines: for line j, its text is text[lines[j]:lines[j+1]].
+Any process can map the file read-only and read a card's lines without
+the text being sent to it, and a restarted process whose cards have the
+same key can reopen it instead of writing it again.
+"""
+
+import array
+import json
+import mmap
+import os
+import struct
+
+import data
+
+ARENAFILE = os.path.join(data.DATADIR, "cache", "rules.arena")
+
+_magic = b'DMYA'
+# magic, format version, header length, number of cards, number of lines
+_prefix = struct.Struct('<4sIIII')
+_version = 1
+
+def _pad(n):
+    return -n % 8
+
+def write(filename, cards, key=''):
+    """ Writes the rules text of the given cards to a new arena file.
+
+        key: Any string identifying the text, eg. cluster.corpus_key of
+            the cards, to be checked by whoever opens the file. """
+    names = []
+    card_table = array.array('I', [0])
+    line_table = array.array('I', [0])
+    chunks = []
+    size = 0
+    for c in sorted(cards, key=lambda c: c.name):
+        names.append(c.name)
+        for line in c.rules.split('\n'):
+            b = line.encode('utf-8')
+            chunks.append(b)
+            size += len(b)
+            line_table.append(size)
+        card_table.append(len(line_table) - 1)
+    if size >= 1 << 32:
+        raise ValueError('Corpus text is too large for an arena.')
+    header = json.dumps({'names': names, 'key': key}).encode('utf-8')
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_prefix.pack(_magic, _version, len(header), len(names),
+                             len(line_table) - 1))
+        f.write(header)
+        f.write(b'\0' * _pad(_prefix.size + len(header)))
+        card_table.tofile(f)
+        line_table.tofile(f)
+        for b in chunks:
+            f.write(b)
+    os.replace(tmp, filename)
+
+class TextArena(object):
+    """ A read-only view of an arena file. """
+    def __init__(self, filename=ARENAFILE):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, hlen, ncards, nlines = _prefix.unpack_from(
+                    self.mm)
+        except struct.error:
+            magic = version = None
+        if magic != _magic or version != _version:
+            self.mm.close()
+            raise ValueError('{} is not a version {} arena file.'
+                             .format(filename, _version))
+        start = _prefix.size
+        header = json.loads(self.mm[start:start + hlen].decode('utf-8'))
+        self.names = header['names']
+        self.key = header['key']
+        self.index = {name: i for i, name in enumerate(self.names)}
+        start += hlen + _pad(start + hlen)
+        view = memoryview(self.mm)
+        self.cards = view[start:start + 4 * (ncards + 1)].cast('I')
+        start += 4 * (ncards + 1)
+        self.lines = view[start:start + 4 * (nlines + 1)].cast('I')
+        self.text_start = start + 4 * (nlines + 1)
+
+    def close(self):
+        self.cards.release()
+        self.lines.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def line_count(self, name):
+        i = self.index[name]
+        return self.cards[i + 1] - self.cards[i]
+
+    def line(self, name, lineno):
+        """ Returns line number lineno (counting from 1) of a card's text. """
+        i = self.index[name]
+        j = self.cards[i] + lineno - 1
+        if not self.cards[i] <= j < self.cards[i + 1]:
+            raise IndexError('{} has no line {}.'.format(name, lineno))
+        return self._text(j)
+
+    def card_lines(self, name):
+        """ Returns the list of lines of a card's text. """
+        i = self.index[name]
+        return [self._text(j) for j in range(self.cards[i], self.cards[i + 1])]
+
+    def rules(self, name):
+        """ Returns a card's text, as in Card.rules. """
+        # The lines are stored without their separators.
+        return '\n'.join(self.card_lines(name))
+
+    def _text(self, j):
+        a = self.text_start + self.lines[j]
+        b = self.text_start + self.lines[j + 1]
+        return self.mm[a:b].decode('utf-8')
@@ -0,0 +1,177 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""benchmark -- Reproducible timings of Demystify's corpus workloads."""
+
+import datetime
+import hashlib
+import json
+import os
+import resource
+import shutil
+import time
+
+import data
+
+BENCHDIR = os.path.join(data.DATADIR, "benchmark")
+RESULTS = os.path.join(BENCHDIR, "results.jsonl")
+BASELINE = os.path.join(BENCHDIR, "baseline.json")
+# The pinned corpus, copied from the card data cache the first time.
+SNAPSHOT = os.path.join(BENCHDIR, "snapshot.json")
+
+# Metrics where an increase is a regression.
+_compared = ('wall', 'cpu')
+
+def file_hash(filename):
+    """ Returns the sha256 hex digest of a file's contents. """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def measure(func):
+    """ Runs func, which should return the number of cards it processed.
+        Returns a dict of wall time and CPU time (including any child
+        processes that were reaped), peak RSS in KB of this process and of
+        its children, and cards per second. """
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    child0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    t0 = time.perf_counter()
+    n = func() or 0
+    wall = time.perf_counter() - t0
+    self1 = resource.getrusage(resource.RUSAGE_SELF)
+    child1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cards': n,
+        'wall': wall,
+        'cpu': _cpu(self1) - _cpu(self0) + _cpu(child1) - _cpu(child0),
+        'peak_rss': self1.ru_maxrss,
+        'peak_child_rss': child1.ru_maxrss,
+        'cards_per_sec': wall and n / wall or 0.0,
+    }
+
+def compare(results, baseline, threshold):
+    """ Returns a list of (workload, metric, baseline value, new value)
+        for every compared metric that got worse by more than threshold,
+        a fraction of the baseline value. """
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in _compared:
+            if res[metric] > base[metric] * (1 + threshold):
+                regressions.append((name, metric, base[metric], res[metric]))
+    return regressions
+
+def print_results(results, baseline):
+    print('{:20} {:>8} {:>9} {:>9} {:>8} {:>10} {:>10}'
+          .format('workload', 'cards', 'wall', 'cpu', 'cards/s',
+                  'rss(KB)', 'vs base'))
+    for name, res in results.items():
+        base = baseline.get(name)
+        delta = ''
+        if base and base['wall']:
+            delta = '{:+.1%}'.format(res['wall'] / base['wall'] - 1)
+        print('{:20} {:8d} {:9.3f} {:9.3f} {:8.0f} {:10d} {:>10}'
+              .format(name, res['cards'], res['wall'], res['cpu'],
+                      res['cards_per_sec'],
+                      max(res['peak_rss'], res['peak_child_rss']), delta))
+
+def pin_snapshot(snapshot=SNAPSHOT):
+    """ Copies the card data cache to snapshot, if snapshot doesn't exist
+        yet. The copy is never updated after that. """
+    if os.path.exists(snapshot) or not os.path.exists(data.JSONCACHE):
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot)), exist_ok=True)
+    shutil.copyfile(data.JSONCACHE, snapshot + '.tmp')
+    os.replace(snapshot + '.tmp', snapshot)
+    print('Pinned {} as the corpus snapshot {}.'
+          .format(data.JSONCACHE, snapshot))
+
+def run(args, workloads):
+    """ Runs each (name, function) in workloads in order, appends the
+        results to args.results and checks them against args.baseline.
+        Returns 1 if any regressions were found, 0 otherwise. """
+    if args.snapshot == SNAPSHOT:
+        pin_snapshot()
+    if not os.path.exists(args.snapshot):
+        print('Error: Corpus snapshot {} does not exist.'
+              .format(args.snapshot))
+        return 1
+    corpus = file_hash(args.snapshot)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            b = json.load(f)
+        if b['corpus'] != corpus:
+            print('Warning: Baseline was recorded against a different '
+                  'corpus snapshot; not comparing.')
+        else:
+            baseline = b['results']
+    results = {}
+    for name, func in workloads:
+        print('Running {}...'.format(name))
+        results[name] = measure(func)
+    record = {
+        'time': datetime.datetime.now().isoformat(),
+        'corpus': corpus,
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)),
+                exist_ok=True)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+    print_results(results, baseline)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)),
+                    exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}.'.format(args.baseline))
+    regressions = compare(results, baseline, args.threshold)
+    for name, metric, old, new in regressions:
+        print('REGRESSION: {} {} {:.3f}s -> {:.3f}s ({:+.1%})'
+              .format(name, metric, old, new, new / old - 1))
+    return regressions and 1 or 0
+
+def add_subcommands(subparsers, func):
+    """ Adds the 'benchmark' command to the main parser, which will call
+        func with the parsed args. func should run the workloads with
+        run(). subparsers should be the object returned by
+        add_subparsers() called on the main parser. """
+    subparser = subparsers.add_parser('benchmark',
+        description='Time the corpus workloads against a pinned snapshot.')
+    subparser.add_argument('--snapshot', default=SNAPSHOT,
+        help=('Scryfall JSON file to load. It is never updated, so that '
+              'results stay comparable. By default, a copy of the card '
+              'data cache made on the first run.'))
+    subparser.add_argument('--results', default=RESULTS,
+        help='File to append results to, one JSON object per line.')
+    subparser.add_argument('--baseline', default=BASELINE,
+        help='File holding the baseline results to compare against.')
+    subparser.add_argument('--save_baseline', action='store_true',
+        help='Save these results as the new baseline.')
+    subparser.add_argument('--threshold', type=float, default=0.1,
+        help=('Fraction by which wall or CPU time may exceed the baseline '
+              'before it is reported as a regression.'))
+    subparser.set_defaults(func=func)
@@ -22,13 +22,17 @@ import logging
 logger = logging.getLogger("card")
 logger.setLevel(logging.INFO)
 
+import collections
 import copy
-import queue
+import functools
+import itertools
+import json
 import multiprocessing
-import multiprocessing.queues
+import multiprocessing.connection
 import re
 import string
 import sys
+import time
 
 import progressbar.bar
 import progressbar.widgets
@@ -51,6 +55,13 @@ all_shortnames = {}
 cards_by_set = {}
 _all_cards = {}
 expect_multi = {}
+# card name -> set of names (of cards or tokens) considered where its text
+# refers to something by name
+name_refs = {}
+# name -> set of names of cards that refer to it (the reverse of name_refs)
+referenced_by = {}
+# names found by format_by_name that aren't card names
+token_names = set()
 
 # Handle any Legendary names we couldn't get with ", " or " the ", most of
 # which have two words only, eg. Arcades Sabboth, or "of the".
@@ -146,6 +157,13 @@ def construct_uname(name):
         alphanumerics and underscores. """
     return nonwords.sub(r'_', str("NAME_" + name))
 
+def add_name(name):
+    """ Adds a card or token name to the names that may be referred to. """
+    uname = construct_uname(name)
+    all_names[name] = uname
+    all_names_inv[uname] = name
+    _name_trie.add(name)
+
 def make_shortname(name):
     if ', ' in name:
         return name[:name.index(', ')].strip()
@@ -171,6 +189,8 @@ class Card(object):
         # TODO: just keep these fields separate?
         self.pt = loyalty or power and (power + '/' + toughness)
         self.rules = str(oracle_text.replace("’", "'"))
+        # The rules before preprocessing, so that it can be redone.
+        self.raw_rules = self.rules
         self.sets = set()
         if set_rarity:
             for s_r in set_rarity.split(', '):
@@ -180,76 +200,133 @@ class Card(object):
                     logger.error("Unknown set_rarity entry for {}: {}"
                                  .format(name, s_r))
         self.sets = sorted(self.sets)
-        # TODO: Do we really need all this logic instead of simply
-        # incorporating the scryfall json references?
+        # Checked against the other cards by validate_cards.
         self.multitype = multitype
         self.multicard = multicard
         self.meld_pair = meld_pair
         self.melded = melded
-        if self.multitype != 'meld':
-            if self.melded:
+
+        self.shortname = None
+        if 'legendary' in self.typeline:
+            self.shortname = str(make_shortname(self.name))
+            if self.shortname:
+                logger.debug("Shortname for {} set to {}."
+                             .format(self.name, self.shortname))
+                all_shortnames[self.shortname] = self.name
+
+        add_name(self.name)
+        _all_cards[self.name] = self
+
+        for s in self.sets:
+            if s not in cards_by_set:
+                cards_by_set[s] = {self.name}
+            else:
+                cards_by_set[s].add(self.name)
+
+    def __eq__(self, c):
+        return type(self) == type(c) and self.name == c.name
+
+    def __ne__(self, c):
+        return type(self) != type(c) or self.name != c.name
+
+    def __hash__(self):
+        return self.name.__hash__()
+
+    def __repr__(self):
+        return ('<{0.__module__}.{0.__name__} instance {1}>'
+                .format(self.__class__, vars(self)))
+
+    def __str__(self):
+        v = vars(self)
+        s = []
+        for c in ['name', 'shortname', 'cost', 'color', 'typeline', 'pt',
+                  'sets', 'rules', 'multitype', 'multicard']:
+            if v[c]:
+                s.append('{}: {}'.format(c, v[c]))
+        return '\n'.join(s)
+
+
+def validate_cards():
+    """ Checks every constructed card's multicard and meld fields against
+        the other cards, logging an error for each inconsistency. This is
+        one pass over the cards in the order they were constructed, each
+        checked against the cards before it, so each pair or meld group is
+        checked once, by its card constructed last.
+
+        Returns a dict of multitype to the set of names of the cards of
+        that multitype, as from multicards(). """
+    # The names of the cards checked so far.
+    earlier = set()
+    faces = {}
+    # multitype -> the names of the other faces of its cards
+    others = {}
+    for c in _all_cards.values():
+        if c.multitype:
+            faces.setdefault(c.multitype, set()).add(c.name)
+            others.setdefault(c.multitype, set()).add(c.multicard)
+        if c.multitype != 'meld':
+            if c.melded:
                 logger.error('Malformed multicard: {} is a {} card to {} but '
                              'melds with {} into {}.'.format(
-                                 self.name, self.multitype, self.multicard,
-                                 self.meld_pair, self.melded))
-            elif self.meld_pair:
+                                 c.name, c.multitype, c.multicard,
+                                 c.meld_pair, c.melded))
+            elif c.meld_pair:
                 logger.error('Malformed multicard: {} is a {} card to {} but '
                              'melds from {}.'.format(
-                                 self.name, self.multitype, self.multicard,
-                                 self.meld_pair))
-            elif (self.multitype and not self.multicard
-                  or self.multicard and not self.multitype):
+                                 c.name, c.multitype, c.multicard,
+                                 c.meld_pair))
+            elif (c.multitype and not c.multicard
+                  or c.multicard and not c.multitype):
                 logger.error('Malformed multicard: {} is a {} card to {}.'
-                             .format(self.name, self.multitype, self.multicard))
-
-        # The other card should have multicard and multitype set
-        # We only need to do this once, so if the other card isn't defined yet,
-        # we can just wait for it to be created.
-        if self.multicard and self.multicard in _all_cards:
-            mc = _all_cards[self.multicard]
-            if mc.multitype != self.multitype:
+                             .format(c.name, c.multitype, c.multicard))
+
+        # The other card should have multicard and multitype set.
+        # This is only checked once per pair, by the face constructed last.
+        if c.multicard and c.multicard in earlier:
+            mc = _all_cards[c.multicard]
+            if mc.multitype != c.multitype:
                 logger.error('Multitype mismatch: {} ({}) vs {} ({})'
-                             .format(self.name, self.multitype,
+                             .format(c.name, c.multitype,
                                      mc.name, mc.multitype))
-            if mc.multicard != self.name:
+            if mc.multicard != c.name:
                 logger.error('Multicard discrepancy: {} ({}) vs {} ({})'
-                             .format(self.name, self.multicard,
+                             .format(c.name, c.multicard,
                                      mc.name, mc.multicard))
-        elif self.multitype == 'meld':
-            mcards = self.melded and [self.melded] or []
-            if self.meld_pair:
-                mcards.extend(self.meld_pair.split('; '))
+        elif c.multitype == 'meld':
+            mcards = c.melded and [c.melded] or []
+            if c.meld_pair:
+                mcards.extend(c.meld_pair.split('; '))
             if len(mcards) != 2:
                 logger.error('Malformed meld card: {} pair/from {} into {}.'
-                             .format(self.name, self.meld_pair, self.melded))
-            elif all(name in _all_cards for name in mcards):
-                if self.melded:
+                             .format(c.name, c.meld_pair, c.melded))
+            elif all(name in earlier for name in mcards):
+                if c.melded:
                     # This is one of the components.
-                    pc = _all_cards[self.meld_pair]
-                    if pc.multitype != self.multitype:
+                    pc = _all_cards[c.meld_pair]
+                    if pc.multitype != c.multitype:
                         logger.error('Multitype mismatch: {} ({}) vs {} ({})'
-                                     .format(self.name, self.multitype,
+                                     .format(c.name, c.multitype,
                                              pc.name, pc.multitype))
                     else:
-                        if pc.meld_pair != self.name:
+                        if pc.meld_pair != c.name:
                             logger.error('Meld pair discrepancy: '
                                          '{} ({}) vs {} ({})'
-                                         .format(self.name, self.meld_pair,
+                                         .format(c.name, c.meld_pair,
                                                  pc.name, pc.meld_pair))
-                        if pc.melded != self.melded:
+                        if pc.melded != c.melded:
                             logger.error('Melded discrepancy: '
                                          '{} ({}) vs {} ({})'
-                                         .format(self.name, self.melded,
+                                         .format(c.name, c.melded,
                                                  pc.name, pc.melded))
-                    mc = _all_cards[self.melded]
-                    if mc.multitype != self.multitype:
+                    mc = _all_cards[c.melded]
+                    if mc.multitype != c.multitype:
                         logger.error('Multitype mismatch: {} ({}) vs {} ({})'
-                                     .format(self.name, self.multitype,
+                                     .format(c.name, c.multitype,
                                              mc.name, mc.multitype))
                     elif (not mc.meld_pair or ';' not in mc.meld_pair
-                          or self.name not in mc.meld_pair.split('; ')):
+                          or c.name not in mc.meld_pair.split('; ')):
                         logger.error('Melded discrepancy: {} ({}) vs {} ({})'
-                                     .format(self.name, self.melded,
+                                     .format(c.name, c.melded,
                                              mc.name, mc.meld_pair))
                     elif pc.name not in mc.meld_pair.split('; '):
                         logger.error('Melded discrepancy: {} ({}) vs {} ({})'
@@ -259,71 +336,45 @@ class Card(object):
                     # This is the melded card.
                     n1, n2 = mcards
                     c1, c2 = _all_cards[n1], _all_cards[n2]
-                    if c1.multitype != self.multitype:
+                    if c1.multitype != c.multitype:
                         logger.error('Multitype mismatch: {} ({}) vs {} ({})'
-                                     .format(self.name, self.multitype,
+                                     .format(c.name, c.multitype,
                                              c1.name, c1.multitype))
-                    elif c2.multitype != self.multitype:
+                    elif c2.multitype != c.multitype:
                         logger.error('Multitype mismatch: {} ({}) vs {} ({})'
-                                     .format(self.name, self.multitype,
+                                     .format(c.name, c.multitype,
                                              c2.name, c2.multitype))
                     else:
-                        if c1.melded != self.name:
+                        if c1.melded != c.name:
                             logger.error('Melded discrepancy: '
                                          '{} ({}) vs {} ({})'
-                                         .format(self.name, self.meld_pair,
+                                         .format(c.name, c.meld_pair,
                                                  c1.name, c1.melded))
-                        if c2.melded != self.name:
+                        if c2.melded != c.name:
                             logger.error('Melded discrepancy: '
                                          '{} ({}) vs {} ({})'
-                                         .format(self.name, self.meld_pair,
+                                         .format(c.name, c.meld_pair,
                                                  c2.name, c2.melded))
                         if c1.meld_pair != c2.name or c1.name != c2.meld_pair:
                             logger.error('Meld pair discrepancy: '
                                          '{} ({}) vs {} ({})'
                                          .format(c1.name, c1.meld_pair,
                                                  c2.name, c2.meld_pair))
+        earlier.add(c.name)
+    for multitype in ('split', 'flip', 'transform'):
+        diff = faces.get(multitype, set()) ^ others.get(multitype, set())
+        if diff:
+            logger.error("Difference: " + "; ".join(map(str, diff)))
+    return faces
 
-        self.shortname = None
-        if 'legendary' in self.typeline:
-            self.shortname = str(make_shortname(self.name))
-            if self.shortname:
-                logger.debug("Shortname for {} set to {}."
-                             .format(self.name, self.shortname))
-                all_shortnames[self.shortname] = self.name
-
-        uname = construct_uname(self.name)
-        all_names[self.name] = uname
-        all_names_inv[uname] = self.name
-        _all_cards[self.name] = self
-
-        for s in self.sets:
-            if s not in cards_by_set:
-                cards_by_set[s] = {self.name}
-            else:
-                cards_by_set[s].add(self.name)
-
-    def __eq__(self, c):
-        return type(self) == type(c) and self.name == c.name
-
-    def __ne__(self, c):
-        return type(self) != type(c) or self.name != c.name
-
-    def __hash__(self):
-        return self.name.__hash__()
-
-    def __repr__(self):
-        return ('<{0.__module__}.{0.__name__} instance {1}>'
-                .format(self.__class__, vars(self)))
-
-    def __str__(self):
-        v = vars(self)
-        s = []
-        for c in ['name', 'shortname', 'cost', 'color', 'typeline', 'pt',
-                  'sets', 'rules', 'multitype', 'multicard']:
-            if v[c]:
-                s.append('{}: {}'.format(c, v[c]))
-        return '\n'.join(s)
+def multicards():
+    """ Returns a dict of multitype to the set of names of the constructed
+        cards of that multitype, without checking them. """
+    faces = {}
+    for c in _all_cards.values():
+        if c.multitype:
+            faces.setdefault(c.multitype, set()).add(c.name)
+    return faces
 
 
 def scryfall_card(layout=None, card_faces=None, all_parts=None,
@@ -391,168 +442,525 @@ class CardProgressBar(list):
 
 ## Multiprocessing support for card-related tasks
 
-class CardProgressQueue(multiprocessing.queues.JoinableQueue):
-    def __init__(self, cards):
-        super(CardProgressQueue, self).__init__(
-                len(cards), ctx=multiprocessing.get_context())
+class CardProgress(object):
+    """ A progress bar for cards that finish in any order. """
+    def __init__(self, total):
         self._cw = CardWidget()
         widgets = [self._cw, ' ', progressbar.widgets.Bar(left='[', right=']'), ' ',
                    progressbar.widgets.SimpleProgress(), ' ', progressbar.widgets.ETA()]
-        self._pbar = progressbar.bar.ProgressBar(widgets=widgets, max_value=len(cards))
+        self._pbar = progressbar.bar.ProgressBar(widgets=widgets, max_value=total)
         self._pbar.start()
-        for c in cards:
-            self.put(c)
-
-    def task_done(self, cname=None):
-        with self._cond:
-            if not self._unfinished_tasks.acquire(False):
-                raise ValueError('task_done() called too many times')
-            self._cw.current_card = cname or ' '
-            if self._unfinished_tasks._semlock._is_zero():
-                self._pbar.finish()
-                self._cond.notify_all()
-            else:
-                self._pbar.update(self._sem._semlock._get_value())
+        self.done = 0
 
-def _card_worker(work_queue, res_queue, func):
-    logger.debug("Card worker starting up - Python {}".format(sys.version))
+    def update(self, cname=None):
+        """ Counts one more card as done. """
+        self.done += 1
+        self._cw.current_card = cname or ' '
+        self._pbar.update(self.done)
+
+    def finish(self):
+        self._pbar.finish()
+
+# Seconds a worker may spend on one card before it is stopped and the card
+# is reported as lost.
+CARD_TIMEOUT = 300
+
+# The number of cards sent to each worker ahead of time, so that it never
+# waits on the parent for its next card.
+_PREFETCH = 2
+
+def run_card_task(conn, func, task, by_name=False):
+    """ Applies func to the card of task, a (sequence number, card or card
+        name) pair, and sends (sequence number, result, seconds taken) over
+        conn. Exceptions are logged and give a result of None. """
+    seq, c = task
+    res = None
+    start = time.perf_counter()
     try:
-        while True:
-            c = work_queue.get(timeout=0.2)
-            try:
-                res = func(c)
-                res_queue.put(res)
-            except queue.Full:
-                logger.error("Result queue full, can't add result for {}."
-                             .format(c.name))
-                res_queue.put(None)
-            except Exception as e:
-                logger.exception('Exception encountered processing {} for '
-                                 '{}: {}'.format(func.__name__, c.name, e))
-                res_queue.put(None)
-            finally:
-                work_queue.task_done(cname=c.name)
-    except queue.Empty:
-        return
+        if by_name:
+            c = _all_cards[c]
+        res = func(c)
     except Exception as e:
-        logger.fatal('Fatal exception processing {}: {}'
-                     .format(func.__name__, e))
+        logger.exception('Exception encountered processing {} for '
+                         '{}: {}'.format(func.__name__,
+                                         getattr(c, 'name', c), e))
+    elapsed = time.perf_counter() - start
+    try:
+        conn.send((seq, res, elapsed))
+    except (EOFError, OSError):
+        raise
+    except Exception as e:
+        logger.exception("Can't send the result of {} for {}: {}"
+                         .format(func.__name__, getattr(c, 'name', c), e))
+        conn.send((seq, None, elapsed))
+
+def _card_worker(inbox, conn, func, by_name=False):
+    """ Applies func to each card sent to inbox, until sent None, and sends
+        (sequence number, result, seconds taken) over conn for each. """
+    logger.debug("Card worker starting up - Python {}".format(sys.version))
+    while True:
+        task = inbox.get()
+        if task is None:
+            return
+        run_card_task(conn, func, task, by_name)
+
+class _Worker(object):
+    """ A worker process, and the cards sent to it that it hasn't finished,
+        in the order sent. """
+    def __init__(self, func, by_name):
+        self.inbox = multiprocessing.Queue()
+        # Don't wait at exit to flush cards to a worker that died.
+        self.inbox.cancel_join_thread()
+        # Results are sent synchronously, so none are lost if the worker
+        # dies, and the pipe reads as closed once it has.
+        self.conn, child_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+                target=_card_worker,
+                args=(self.inbox, child_conn, func, by_name),
+                daemon=True)
+        self.process.start()
+        child_conn.close()
+        # deque of (sequence number, card or card name)
+        self.assigned = collections.deque()
+        # When the worker started on the first assigned card.
+        self.started = None
+
+    def send(self, seq, item):
+        if not self.assigned:
+            self.started = time.monotonic()
+        self.assigned.append((seq, item))
+        self.inbox.put((seq, item))
+
+    def stop(self):
+        """ Asks the worker to exit, once it finishes its cards. """
+        self.inbox.put(None)
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+
+    def exit_reason(self):
+        """ Returns why the worker's pipe closed. """
+        self.process.join()
+        return 'worker died with exit code {}'.format(self.process.exitcode)
+
+    def finish(self, timeout):
+        """ Waits for a stopped worker to exit, killing it if it takes more
+            than timeout seconds, and closes it. """
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+        self.close()
+
+    def close(self):
+        self.conn.close()
+        self.inbox.close()
+
+class LocalBackend(object):
+    """ Runs map_multi's workers as child processes of this one.
+
+        A backend provides workers on demand; each worker has a conn to wait
+        on for (sequence number, result, seconds taken) triples, and the
+        methods of _Worker. See cluster.ClusterBackend for another. """
+    # Seconds to wait while the backend has no workers before giving up on
+    # the remaining cards, or None if workers are always available.
+    patience = None
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+
+    def workers(self, func, by_name, count, timeout=None):
+        """ Returns up to count new workers for func. The timeout isn't
+            needed, since map_multi can kill a local worker itself. """
+        return [_Worker(func, by_name) for _ in range(count)]
 
-def map_multi(func, cards, processes=None):
+class CardTask(object):
+    """ A function for map_multi with its leading arguments bound, named
+        name (or func's name). Unlike a closure, it can be pickled and sent
+        to a worker on another machine (see cluster) if func can. """
+    def __init__(self, func, *args, name=None):
+        self.func = func
+        self.args = args
+        self.__name__ = name or func.__name__
+
+    def __call__(self, c):
+        return self.func(*(self.args + (c,)))
+
+def _text_length(c):
+    return len(getattr(c, 'rules', '') or '')
+
+class CardTimes(object):
+    """ How long each card took in the latest run of each function given
+        to map_multi, by the function's name, so that later runs can hand
+        out the slowest cards first. Can be saved to a JSON file. """
+    def __init__(self, filename=None):
+        self.filename = filename
+        # function name -> card name -> seconds
+        self.times = {}
+        # function name -> estimated seconds per character of text
+        self._rates = {}
+        if filename:
+            try:
+                with open(filename) as f:
+                    self.times = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    def record(self, task, name, seconds):
+        self.times.setdefault(task, {})[name] = round(seconds, 6)
+        self._rates.pop(task, None)
+
+    def _rate(self, task):
+        """ Returns the function's time per character of text, over the
+            loaded cards it has times for. """
+        if task not in self._rates:
+            ts = self.times.get(task, {})
+            chars = sum(_text_length(_all_cards[n]) for n in ts
+                        if n in _all_cards)
+            total = sum(t for n, t in ts.items() if n in _all_cards)
+            self._rates[task] = chars and total / chars or 1.0
+        return self._rates[task]
+
+    def estimate(self, task, c):
+        """ Returns the card's time in the latest run of the function, or
+            if it has none, an estimate from the length of its text. """
+        t = self.times.get(task, {}).get(c.name)
+        if t is None:
+            return _text_length(c) * self._rate(task)
+        return t
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        with open(filename, 'w') as f:
+            json.dump(self.times, f, indent=0, sort_keys=True)
+
+def map_multi(func, cards, processes=None, by_name=False,
+              timeout=CARD_TIMEOUT, retries=1, lost=None, times=None,
+              backend=None):
     """ Applies a given function to each card in cards, utilizing
-        multiple processes, and displaying progress with a CardProgressBar.
+        multiple processes, and displaying progress with a progress bar.
         Results are not guaranteed to be in any order relating to the
         initial order of cards, and all None results and exceptions thrown
         are stripped out. If correlated results are desired, the function
         should return the name of the card alongside the result.
 
+        The parent process supervises the workers: it knows which cards
+        each worker has, stops a worker that spends more than timeout
+        seconds on one card, and replaces any worker that dies or is
+        stopped. A card whose worker died is sent to another worker up to
+        retries more times; a card that timed out is not retried. Cards
+        that couldn't be processed are logged as errors, and map_multi
+        always returns once every card is either done or lost.
+
+        Cards are handed out longest first, so that no long card is left
+        to run on its own at the end: by their times in earlier runs of the
+        same function if times is given, and by the length of their text
+        otherwise.
+
         func: A function that takes in a single Card object as an argument.
             Any modifications this function makes to Card data will be lost
             when it exits, hence it should return said data and the callee
             should modify the Card as specified. The only caveat to this is
-            that the data it returns must be pickleable.
+            that the data it returns must be pickleable. For backends on
+            other machines, func must be pickleable too, eg. a module-level
+            function or a CardTask of one.
         cards: An iterable of Card objects that supports __len__.
         processes: The number of processes. If None, defaults to the 
-            number of CPUs. """
+            backend's number, which for the LocalBackend is the number of
+            CPUs.
+        by_name: If True, only the names of the cards are sent to the
+            worker processes, which look up the cards in their own copy of
+            the loaded cards. This saves pickling the cards, but the workers
+            only see the cards as they were when map_multi was called.
+        timeout: Seconds allowed per card, or None for no limit.
+        retries: How many times to retry a card after its worker died.
+        lost: If given, a list to which (card name, reason) is appended
+            for each card that couldn't be processed.
+        times: If given, a CardTimes whose times for this function (by
+            its __name__) order the cards, and which the new times are
+            recorded to.
+        backend: Where to run the workers, eg. a cluster.ClusterBackend.
+            Defaults to a LocalBackend. """
+    if backend is None:
+        backend = LocalBackend()
     if not processes:
-        processes = multiprocessing.cpu_count()
-    q = CardProgressQueue(cards)
-    rq = multiprocessing.Queue()
-    pr = [multiprocessing.Process(target=_card_worker, args=(q, rq, func))
-          for i in range(processes)]
-    for p in pr:
-        p.start()
-    q.join()
+        processes = backend.processes
+    if times is not None:
+        cost = functools.partial(times.estimate, func.__name__)
+    else:
+        cost = _text_length
+    cards = sorted(cards, key=cost, reverse=True)
+    names = [c.name for c in cards]
+    # (sequence number, card or card name) not yet sent to a worker
+    pending = collections.deque(enumerate(by_name and names or cards))
+    attempts = collections.Counter()
+    progress = CardProgress(len(names))
+    workers = []
     result = []
-    for i in range(len(cards)):
-        res = rq.get()
+    lost_here = []
+    # Workers that died without any cards since the last card finished.
+    idle_deaths = 0
+    # When the backend last had no workers for the pending cards.
+    unstaffed = None
+
+    def finish(seq, res=None):
+        progress.update(names[seq])
         if res is not None:
             result.append(res)
-    for p in pr:
-        p.join()
+
+    def lose(seq, reason):
+        lost_here.append((names[seq], reason))
+        finish(seq)
+
+    try:
+        while progress.done < len(names):
+            if pending and len(workers) < processes:
+                workers.extend(backend.workers(func, by_name,
+                                               processes - len(workers),
+                                               timeout))
+            if workers or not pending:
+                unstaffed = None
+            elif unstaffed is None:
+                unstaffed = time.monotonic()
+            elif time.monotonic() - unstaffed > backend.patience:
+                logger.error('No card workers for {} seconds; giving up.'
+                             .format(backend.patience))
+                while pending:
+                    lose(pending.popleft()[0], 'no workers')
+                break
+            # Deal the cards out a round at a time, so that the longest
+            # ones go to different workers.
+            for depth in range(1, _PREFETCH + 1):
+                for w in workers:
+                    if pending and len(w.assigned) < depth:
+                        w.send(*pending.popleft())
+
+            # worker -> (reason it was given up on, whether to retry its card)
+            failed = {}
+            ready = multiprocessing.connection.wait(
+                    [w.conn for w in workers], timeout=0.1)
+            for w in workers:
+                if w.conn not in ready:
+                    continue
+                try:
+                    while w.conn.poll():
+                        seq, res, elapsed = w.conn.recv()
+                        w.assigned.popleft()
+                        w.started = time.monotonic()
+                        idle_deaths = 0
+                        finish(seq, res)
+                        if times is not None:
+                            times.record(func.__name__, names[seq], elapsed)
+                except (EOFError, OSError):
+                    failed[w] = (w.exit_reason(), True)
+            now = time.monotonic()
+            for w in workers:
+                if (w not in failed and timeout and w.assigned
+                        and now - w.started > timeout):
+                    w.kill()
+                    failed[w] = ('timed out after {} seconds'
+                                 .format(timeout), False)
+
+            for w, (reason, retry) in failed.items():
+                workers.remove(w)
+                w.close()
+                if not w.assigned:
+                    idle_deaths += 1
+                    continue
+                seq, item = w.assigned.popleft()
+                attempts[seq] += 1
+                if retry and attempts[seq] <= retries:
+                    logger.warning('Retrying {}: {}.'
+                                   .format(names[seq], reason))
+                    w.assigned.appendleft((seq, item))
+                else:
+                    lose(seq, reason)
+                # The worker never started on the rest.
+                pending.extendleft(reversed(w.assigned))
+            if idle_deaths > processes:
+                logger.error('Card workers keep dying; giving up.')
+                while pending:
+                    lose(pending.popleft()[0], 'no workers')
+    finally:
+        for w in workers:
+            w.stop()
+        for w in workers:
+            w.finish(1)
+        progress.finish()
+    if lost_here:
+        logger.error('{} cards could not be processed by {}: {}'.format(
+                len(lost_here), func.__name__,
+                '; '.join('{} ({})'.format(*l) for l in lost_here)))
+        if lost is not None:
+            lost.extend(lost_here)
     return result
 
 ## cardname processing ##
 
-def potential_names(words, cardnames):
-    """ cardnames is a list of potential names, either SELF or PARENT,
-        that should not be replaced with NAME_ tokens. """
+class NameTrie(object):
+    """ A trie of names by word, for finding which runs of words in a text
+        are names without building every candidate string. """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, name):
+        node = self.root
+        for w in name.split(' '):
+            node = node.setdefault(w, {})
+        # None marks the end of a name.
+        node[None] = name
+
+    def ends(self, words, start):
+        """ Returns the set of positions end such that words[start:end],
+            less any comma at the very end, are the words of a name. """
+        result = set()
+        node = self.root
+        for end in range(start + 1, len(words) + 1):
+            w = words[end - 1]
+            last = node.get(w[:-1] if w[-1:] == ',' else w)
+            if last is not None and None in last:
+                result.add(end)
+            node = node.get(w)
+            if node is None:
+                break
+        return result
+
+_name_trie = NameTrie()
+
+# Words that may appear between the capitalized words of a name.
+_name_fillers = {'of', 'from', 'to', 'in', 'on', 'the', 'a'}
+
+def split_names(words, cardnames, refs=None):
+    """ Returns the names referred to by words, the words following a name
+        reference: the first of the candidate ways to split the words into
+        names (see _candidate_pieces) whose names are all known, or else the
+        first candidate, the longest possible name. The candidates are tried
+        as runs of words checked against the trie of known names, stopping
+        at the first one that is good.
+
+        cardnames is a list of potential names, either SELF or PARENT, that
+        should not be replaced with NAME_ tokens.
+
+        If refs is a set, the names of every candidate tried, and the names
+        returned, are added to it. """
+    result = _split_names(words, cardnames, refs)
+    if refs is not None:
+        refs.update(result)
+    return result
+
+def _split_names(words, cardnames, refs):
+    """ split_names, except that the names returned without trying any
+        candidates aren't added to refs. """
     name = words[0]
-    name2 = ''
-    namelist = False
     if name[-1] in ':."':
-        yield (name[:-1],)
-    else:
-        for i, w in enumerate(words[1:]):
-            if w[0].isupper():
-                name += name2 + ' ' + w
-                name2 = ''
-                if name[-1] in ':."':
-                    break
-            elif w in ['of', 'from', 'to', 'in', 'on', 'the', 'a']:
-                name2 += ' ' + w
-            elif w in ['and', 'or']:
-                namelist = True
-                name2 += ' ' + w
-            else:
+        return (name[:-1],)
+    # Find the words of the longest possible name: capitalized words and
+    # the words between them, up to the end of a sentence.
+    m = 1
+    namelist = False
+    for i, w in enumerate(words[1:]):
+        if w[0].isupper():
+            m = i + 2
+            if w[-1] in ':."':
                 break
-        name = name.rstrip(',.:"')
-        if ', ' in name:
-            ns = name.split(', ', 1)
-            if ns[0] == ns[1] and ns[0] in cardnames:
-                yield (ns[0],)
-                return
-        yield (name, )
-        if namelist:
-            for sep in [' and ', ' or ']:
-                names = name.split(sep)
-                if len(names) > 1:
-                    # pick each separator, join the rest,
-                    # split those left of it on commas
-                    # and iterate through joining them
-                    # (but only from the left)
-                    # eg. Example, This and That, Silly, and Serious or Not
-                    # when "Example, This and That", "Silly", and
-                    #      "Serious or Not" are the card names
-                    for i in range(len(names) - 1, 0, -1):
-                        left = sep.join(names[:i])
-                        right = sep.join(names[i:])
-                        lnames = left.split(', ')
-                        if lnames[-1][-1] == ',':
-                            lnames[-1] = lnames[-1][:-1]
-                            # we saw ", and " for a 2-card list?
-                            # the latter is probably SELF or PARENT
-                            if len(lnames) == 1 and right in cardnames:
-                                yield (lnames[0], )
-                        if len(lnames) > 1:
-                            yield tuple(lnames) + (right, )
-                            if len(lnames) > 2:
-                                for j in range(len(lnames) - 2, 1, -1):
-                                    yield ((', '.join(lnames[:j]), )
-                                           + tuple(lnames[j:])
-                                           + (right, ))
-                                # don't include right in this last case
-                                # if it's SELF or PARENT
-                                t = ((', '.join(lnames[:-1]), )
-                                     + tuple(lnames[-1:]))
-                                if right not in cardnames:
-                                    t += (right, )
-                                yield t
-                        else:
-                            yield (left, right)
+        elif w in _name_fillers:
+            pass
+        elif w in ('and', 'or'):
+            namelist = True
         else:
-            names = name.split(', ')
-            while len(names) > 1:
-                del names[-1]
-                yield (', '.join(names), )
+            break
+    ws = words[:m]
+    ws[-1] = ws[-1].rstrip(',.:"')
+    name = ' '.join(ws)
+    if ', ' in name:
+        ns = name.split(', ', 1)
+        if ns[0] == ns[1] and ns[0] in cardnames:
+            return (ns[0],)
+    if not ws[-1]:
+        # Nothing left of the name to look up.
+        return (name,)
+
+    ends = {}
+    def _text(piece):
+        a, b, strip = piece
+        s = ' '.join(ws[a:b])
+        return s[:-1] if strip and s[-1] == ',' else s
+    def _known(piece):
+        a, b, strip = piece
+        if not strip:
+            return _text(piece) in all_names
+        if a not in ends:
+            ends[a] = _name_trie.ends(ws, a)
+        return b in ends[a]
+
+    for pieces in _candidate_pieces(ws, namelist, cardnames, _text):
+        if refs is not None:
+            refs.update(map(_text, pieces))
+        if all(map(_known, pieces)):
+            return tuple(map(_text, pieces))
+    return (name,)
 
-def format_by_name(names, words):
+def _candidate_pieces(ws, namelist, cardnames, text):
+    """ Yields the candidate ways to split the name made of the words ws
+        into names, each as a list of (start, end, strip) runs of words,
+        where strip says whether to drop a comma at the end: the whole name,
+        then for a list of names, each way of splitting it at 'and' or 'or'
+        and at the commas to the left, and otherwise the name cut short at
+        each comma. """
+    m = len(ws)
+    yield [(0, m, True)]
+    if not namelist:
+        for q in range(m - 2, -1, -1):
+            if ws[q][-1] == ',':
+                yield [(0, q + 1, True)]
+        return
+    for sep in ('and', 'or'):
+        for p in range(m - 1, 0, -1):
+            if ws[p] != sep:
+                continue
+            right = (p + 1, m, True)
+            # The runs of words between commas before the separator.
+            lnames = []
+            a = 0
+            for q in range(p - 1):
+                if ws[q][-1] == ',':
+                    lnames.append((a, q + 1, True))
+                    a = q + 1
+            lnames.append((a, p, True))
+            if (ws[p - 1][-1] == ',' and len(lnames) == 1
+                    and text(right) in cardnames):
+                yield [lnames[0]]
+            if len(lnames) > 1:
+                yield lnames + [right]
+                if len(lnames) > 2:
+                    for j in range(len(lnames) - 2, 1, -1):
+                        yield ([(0, lnames[j - 1][1], True)] + lnames[j:]
+                               + [right])
+                    t = [(0, lnames[-2][1], True), lnames[-1]]
+                    if text(right) not in cardnames:
+                        t.append(right)
+                    yield t
+            else:
+                yield [(0, p, False), right]
+
+class UnknownName(Exception):
+    """ Raised by preprocess_names with tokens=False at a name that isn't
+        known. """
+    def __init__(self, name):
+        super().__init__(name)
+        self.name = name
+
+def format_by_name(names, words, tokens=True):
+    """ Returns words with the names at the start replaced by their NAME_
+        symbols. Unknown names are added as token names, unless tokens is
+        False, in which case UnknownName is raised. """
     for name in names:
         if name not in all_names:
+            if not tokens:
+                raise UnknownName(name)
             logger.info("Found token name: {}".format(name))
-            uname = construct_uname(name)
-            all_names[name] = uname
-            all_names_inv[uname] = name
+            token_names.add(name)
+            add_name(name)
     if len(names) == 1:
         # number of words == number of spaces + 1
         ll = len([a for a in names[0] if a == ' ']) + 1
@@ -579,27 +987,68 @@ def format_by_name(names, words):
 # For testing PARENT detection.
 _parentcards = set()
 
+# name -> compiled regex matching the name as a whole word
+_name_patterns = {}
+
+def _name_pattern(cardname):
+    r = _name_patterns.get(cardname)
+    if r is None:
+        r = _name_patterns[cardname] = re.compile(
+                r"\b{}(?!\w)".format(cardname), flags=re.UNICODE)
+    return r
+
 def preprocess_cardname(line, selfnames=(), parentnames=()):
     """ Checks only for matches against a card's name. """
     change = False
     for cardname in selfnames:
         if cardname in line:
-            line, count = re.subn(r"\b{}(?!\w)".format(cardname),
-                                  "SELF", line, flags=re.UNICODE)
+            line, count = _name_pattern(cardname).subn("SELF", line)
             if count > 0:
                 change = True
     for cardname in parentnames:
         if cardname in line:
-            line, count = re.subn(r"\b{}(?!\w)".format(cardname),
-                                  "PARENT", line, flags=re.UNICODE)
+            line, count = _name_pattern(cardname).subn("PARENT", line)
             if count > 0:
                 change = True
                 _parentcards.add(cardname)
     return line, change
 
-def preprocess_names(line, selfnames=(), parentnames=()):
+# Words that mark an ability as granted to something else, or to oneself.
+_parent_words = re.compile(r"(?<!\S)(equipped|enchanted|fortified|create|each"
+                           r"|SELF)(?=\s|, |$)")
+
+def _grants_to_parent(text):
+    """ Returns whether an ability quoted after text is granted to something
+        other than the card itself.
+
+        Instead of a greedy reverse search for a related word, the text is
+        split on ", " (and the last part on " and "), and the last segment
+        with a related word decides: SELF if the first such word in it is
+        SELF, otherwise the parent. With no such words, it's the parent. """
+    matches = list(_parent_words.finditer(text))
+    if not matches:
+        return True
+    pos = matches[-1].start()
+    start = text.rfind(', ', 0, pos)
+    start = 0 if start < 0 else start + 2
+    if text.find(', ', pos) < 0:
+        a = text.rfind(' and ', start, pos)
+        if a >= 0:
+            start = a + 5
+    for m in matches:
+        if m.start() >= start:
+            return m.group(1) != 'SELF'
+
+def preprocess_names(line, selfnames=(), parentnames=(), refs=None,
+                     tokens=True):
     """ This requires that each card was instantiated as a Card and their names
-        added to the all_names dicts as appropriate. """
+        added to the all_names dicts as appropriate.
+
+        If refs is a set, every name considered where the text refers to
+        something by name is added to it, whether or not it was chosen
+        (see split_names).
+        If tokens is False, a chosen name that isn't known raises
+        UnknownName instead of being added as a token name. """
     change = False
     match = name_ref.search(line)
     while match:
@@ -607,21 +1056,11 @@ def preprocess_names(line, selfnames=(), parentnames=()):
         i, j = match.regs[0]
         words = line[j:].split()
         if not words[0][0].islower():
-            good = []
-            bad = []
-            for names in potential_names(words, selfnames + parentnames):
-                if all((name in all_names for name in names)):
-                    good += [names]
-                else:
-                    bad += [names]
-            if len(good) > 1:
-                logger.warning("Multiple name splits possible: {}."
-                               .format("; ".join(map(str, good))))
-            res = good and good[0] or bad and bad[0] or None
+            res = split_names(words, selfnames + parentnames, refs)
             if res:
                 logger.debug("Selected name(s) at position {} "
                               "as: {}".format(j, "; ".join(res)))
-                line = (line[:j] + format_by_name(res, words))
+                line = (line[:j] + format_by_name(res, words, tokens))
                 if len(res) == 1 and '"' not in line[:i] and not parentnames:
                     # Check for abilities granted
                     t = abil.search(line[j:])
@@ -630,7 +1069,7 @@ def preprocess_names(line, selfnames=(), parentnames=()):
                         # Created tokens don't get shortnames
                         line = (line[:m + j]
                                 + preprocess_names(t.group(), (res[0],),
-                                                   selfnames)
+                                                   selfnames, refs, tokens)
                                 + line[n + j:])
                         j += n
                 change = True
@@ -650,36 +1089,19 @@ def preprocess_names(line, selfnames=(), parentnames=()):
         # else: how do we determine it? So far, all granted abilities are
         # from a) self-granting, b) creating tokens, c) enchanting/equipping.
         # d) 'each' effects like Torrent of Lava or Slivers.
-        parentwords = ('equipped', 'enchanted', 'fortified', 'create', 'each')
-        i = 0
-        t = abil.search(line[i:])
+        t = abil.search(line)
         if t:
-            m, _ = t.regs[0]
-            parent = True
-            # Instead of a greedy reverse search for a related word
-            # split the phrase on "," and " and " and search each segment.
-            segments = preprocess_cardname(line[:m], selfnames)[0].split(', ')
-            segments[-1:] = segments[-1].split(' and ')
-            for segment in reversed(segments):
-                for w in segment.split():
-                    if w in parentwords:
-                        break
-                    elif w == 'SELF':
-                        parent = False
-                        break
-                else:
-                    continue
-                break
+            parent = _grants_to_parent(
+                    preprocess_cardname(line[:t.start()], selfnames)[0])
         while t:
-            m, n = t.regs[0]
+            m, n = t.span()
             if parent:
                 mid, change = preprocess_cardname(t.group(), (), selfnames)
             else:
                 mid, change = preprocess_cardname(t.group(), selfnames)
-            line = (line[:m + i] + mid + line[n + i:])
+            line = (line[:m] + mid + line[n:])
             abil_change = abil_change or change
-            i += n
-            t = abil.search(line[i:])
+            t = abil.search(line, m + len(mid))
     # CARDNAME processing occurs after the "named" processing
     line, cardname_change = preprocess_cardname(line, selfnames, parentnames)
     if abil_change:
@@ -738,20 +1160,196 @@ def preprocess_misc(text):
     text = _pw.sub("-", text)
     return text
 
+_keep_case = re.compile(r"SELF|PARENT|NAME_")
+
+def preprocess_line(line):
+    """ Does the work of preprocess_capitals and then preprocess_misc on a
+        line, lowercasing it all at once and putting back only the words
+        to leave capitalized, instead of splitting it into words. """
+    if len(line) == 1:
+        return line == '−' and '-' or line
+    if line[:1] == '−':
+        line = '-' + line[1:]
+    text = line.lower()
+    has_non = 'non' in text
+    m = _keep_case.search(line)
+    if m:
+        if len(text) != len(line):
+            # Lowercasing changed some offsets, so go word by word.
+            return preprocess_misc(preprocess_capitals(line))
+        out = []
+        i = 0
+        while m:
+            # Put back the whole word, which goes up to spaces on both sides.
+            j = line.rfind(' ', 0, m.start()) + 1
+            k = line.find(' ', m.end())
+            if k < 0:
+                k = len(line)
+            out.append(text[i:j])
+            out.append(line[j:k])
+            i = k
+            m = _keep_case.search(line, k)
+        out.append(text[i:])
+        text = ''.join(out)
+    if has_non:
+        text = _non.sub(r"non-\1", text)
+    return text
+
+## Name reference graph ##
+
+def set_name_refs(cardname, refs):
+    """ Records the names a card's text refers to, replacing any
+        earlier record for the card. """
+    for name in name_refs.get(cardname, ()):
+        referenced_by[name].discard(cardname)
+        if not referenced_by[name]:
+            del referenced_by[name]
+    name_refs[cardname] = set(refs)
+    for name in refs:
+        referenced_by.setdefault(name, set()).add(cardname)
+
+def affected_cards(names):
+    """ Returns the set of Cards whose preprocessing (and so parsing) may
+        change when the cards or tokens with the given names change, appear
+        or disappear: those cards themselves, and every card that refers to
+        one of the names. """
+    cnames = set()
+    for name in names:
+        cnames.add(all_shortnames.get(name, name))
+        cnames.update(referenced_by.get(name, ()))
+    return {_all_cards[n] for n in cnames if n in _all_cards}
+
+def save_name_refs(filename):
+    """ Saves the name reference graph and token names as JSON, for other
+        tools to read. This process's graph is always the one built while
+        preprocessing (from the cache, where possible). """
+    with open(filename, 'w') as f:
+        json.dump({'refs': {n: sorted(r) for n, r in name_refs.items()},
+                   'tokens': sorted(token_names)}, f, indent=0,
+                  sort_keys=True)
+
 ## Main entry point for the preprocessing step ##
 
-def preprocess_all(cards):
+# Increase this whenever a change to preprocessing changes its results,
+# so that cached results are not used (see prepcache).
+PREPROCESS_VERSION = 2
+
+class PreprocessPlan(object):
+    """ The parts of preprocessing a card that don't depend on other cards,
+        worked out once from its original text: the names it refers to
+        itself by, and its lines with reminder text removed, along with
+        whether each line has anything for preprocess_names to do (a name
+        reference, a quoted ability or one of its own names). """
+    def __init__(self, c):
+        self.raw_rules = c.raw_rules
+        self.selfnames = (c.name,)
+        if c.shortname:
+            self.selfnames += (c.shortname,)
+        self.lines = [preprocess_reminder(line)
+                      for line in c.raw_rules.split("\n")]
+        self.named = [bool('"' in line or name_ref.search(line)
+                           or any(n in line for n in self.selfnames))
+                      for line in self.lines]
+
+# card name -> PreprocessPlan
+_plans = {}
+
+def preprocess_plan(c):
+    """ Returns the PreprocessPlan for a card, making it if necessary. """
+    plan = _plans.get(c.name)
+    if (plan is None or plan.raw_rules is not c.raw_rules
+            and plan.raw_rules != c.raw_rules):
+        plan = _plans[c.name] = PreprocessPlan(c)
+    return plan
+
+def _use_cached(c, cached):
+    rules, refs, tokens = cached
+    for name in tokens:
+        if name not in all_names:
+            token_names.add(name)
+            add_name(name)
+    c.rules = rules
+    set_name_refs(c.name, [name for name, _ in refs])
+
+def _preprocess_text(c, refs, tokens=True):
+    """ Returns the card's preprocessed rules text, adding the names it
+        refers to to refs. """
+    plan = preprocess_plan(c)
+    lines = []
+    for line, named in zip(plan.lines, plan.named):
+        if named:
+            line = preprocess_names(line, plan.selfnames, refs=refs,
+                                    tokens=tokens)
+        lines.append(preprocess_line(line))
+    return "\n".join(lines)
+
+def preprocess_card(c, cache=None):
+    """ Preprocesses one card, as in preprocess_all. The cache isn't
+        flushed. """
+    if cache:
+        cached = cache.get(c)
+        if cached:
+            _use_cached(c, cached)
+            return
+        known = len(all_names)
+    refs = set()
+    c.rules = _preprocess_text(c, refs)
+    set_name_refs(c.name, refs)
+    if cache:
+        # Names are only ever added, so the new ones are at the end.
+        tokens = list(itertools.islice(reversed(all_names),
+                                       len(all_names) - known))
+        cache.add(c, c.rules,
+                  [(name, name in all_names and name not in tokens)
+                   for name in refs], tokens)
+
+def preprocess_early(c, cache=None):
+    """ Preprocesses a card while the cards are still being loaded, if the
+        result can't change as more names become known: every name its text
+        refers to is known already, so the first choice of names is taken
+        wherever a name is referred to (see split_names), and no token names
+        are added.
+
+        Returns None if the card was preprocessed, or otherwise a name that
+        isn't known yet. The card should be tried again once that name is
+        known, or preprocessed with preprocess_card once every card is
+        loaded. """
+    if cache:
+        entry = cache.entry(c)
+        if entry and not entry[2] and all(known and name in all_names
+                                          for name, known in entry[1]):
+            _use_cached(c, cache.get(c))
+            return None
+    refs = set()
+    try:
+        rules = _preprocess_text(c, refs, tokens=False)
+    except UnknownName as e:
+        return e.name
+    unknown = sorted(name for name in refs if name not in all_names)
+    if unknown:
+        return unknown[0]
+    c.rules = rules
+    set_name_refs(c.name, refs)
+    if cache:
+        cache.add(c, rules, [(name, True) for name in refs], [])
+    return None
+
+def preprocess_all(cards, cache=None):
     """ Scans the rules texts of every card to replace any card names that
-        appear with appropriate symbols, and eliminates reminder text. """
+        appear with appropriate symbols, and eliminates reminder text.
+        This starts from each card's original text, so it may be run again
+        on cards whose text or referenced names have changed.
+
+        cache: If provided, a prepcache.PreprocessCache. Only the cards
+            without a valid entry in it are preprocessed, and their results
+            are added to it. """
     print("Processing cards for card names...")
     for c in CardProgressBar(cards):
-        names = (c.name,)
-        if c.shortname:
-            names += (c.shortname,)
-        lines = [preprocess_capitals(preprocess_names(
-                    preprocess_reminder(line), names))
-                 for line in c.rules.split("\n")]
-        c.rules = preprocess_misc("\n".join(lines))
+        preprocess_card(c, cache)
+    if cache:
+        cache.flush()
+        print("{} cards preprocessed, {} from the cache."
+              .format(cache.hits + cache.misses, cache.hits))
 
 def get_cards():
     """ Returns a set of all the Cards instantiated with the Card class. """
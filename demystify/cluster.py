@@ -0,0 +1,401 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""cluster -- Card workers on other machines, for card.map_multi.
+
+A ClusterBackend listens on a TCP address, and worker processes anywhere
+connect to it with multiprocessing.connection, authenticated by a shared
+key. Each worker loads and preprocesses the corpus itself, then sends a key
+identifying its cards (see corpus_key), and is only given work if that
+matches the cards of the process running map_multi.
+
+Over one connection, the backend sends
+    ('job', func, by_name, timeout)
+(or ('reject', reason) if the cards don't match), then (sequence number,
+card or card name) pairs, then None at the end of the job, after which the
+worker waits for the next job. The worker sends back (sequence number,
+result, seconds taken) for each card, just as a local worker does, so
+map_multi supervises both the same way: a connection that closes is a worker
+that died. Since map_multi can only close the connection of a worker that
+takes too long on a card, the worker enforces the timeout itself too, a
+little later, by exiting; run_workers then starts another in its place.
+
+Since the functions are pickled by reference, they must be module-level
+functions (or card.CardTasks of them) of the same code on every
+machine.
+"""
+
+import collections
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import card
+
+clog = logging.getLogger("cluster")
+clog.setLevel(logging.INFO)
+
+AUTHKEY_ENV = 'DEMYSTIFY_AUTHKEY'
+
+# Seconds map_multi waits for a worker to connect before giving up.
+PATIENCE = 60
+
+# Seconds between a worker's attempts to connect.
+_RETRY = 2
+
+# Seconds a worker allows itself on a card beyond map_multi's timeout, so
+# that map_multi gives up on the card first and doesn't retry it.
+_GRACE = 5
+
+def corpus_key(cards=None):
+    """ Returns a hash of the names and rules text of the cards (by default,
+        all loaded cards). """
+    h = hashlib.sha1(str(card.PREPROCESS_VERSION).encode('utf-8'))
+    for c in sorted(cards or card.get_cards(), key=lambda c: c.name):
+        h.update(c.name.encode('utf-8'))
+        h.update(b'\0')
+        h.update(c.rules.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def parse_address(text):
+    """ Returns (host, port) for 'host:port' or ':port'. An empty host
+        means every interface. """
+    host, sep, port = text.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError('Expected host:port, not {!r}.'.format(text))
+    return host, int(port)
+
+def get_authkey(authkey=None):
+    """ Returns the authkey as bytes, from the argument or the environment,
+        or None if neither has one. """
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    return authkey.encode('utf-8') if authkey else None
+
+class _RemoteWorker(object):
+    """ A connected worker, and the cards sent to it that it hasn't
+        finished, in the order sent. """
+    def __init__(self, backend, conn, peer, key):
+        self.backend = backend
+        self.conn = conn
+        self.peer = peer
+        self.key = key
+        # deque of (sequence number, card or card name)
+        self.assigned = collections.deque()
+        self.started = None
+        self.closed = False
+
+    def start(self, func, by_name, timeout):
+        """ Sends the job, returning False if the worker is gone. """
+        try:
+            self.conn.send(('job', func, by_name, timeout))
+        except (EOFError, OSError):
+            self.close()
+            return False
+        return True
+
+    def send(self, seq, item):
+        if not self.assigned:
+            self.started = time.monotonic()
+        self.assigned.append((seq, item))
+        try:
+            self.conn.send((seq, item))
+        except (EOFError, OSError):
+            # The connection reads as closed too, and map_multi will find
+            # out when it next waits on it.
+            pass
+
+    def stop(self):
+        """ Ends the job. The worker stays connected for the next one. """
+        try:
+            self.conn.send(None)
+        except (EOFError, OSError):
+            self.close()
+
+    def kill(self):
+        # The worker's process carries on with its card until its own
+        # timeout, then exits (see _run_jobs), and another takes its place.
+        self.close()
+
+    def exit_reason(self):
+        return 'lost the connection to the worker at {}'.format(self.peer)
+
+    def finish(self, timeout):
+        """ Hands the connection back to the backend if the worker finished
+            its cards, or closes it otherwise. """
+        if self.closed or self.assigned:
+            self.close()
+        else:
+            self.backend.idle.put((self.conn, self.peer, self.key))
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+class ClusterBackend(object):
+    """ A map_multi backend whose workers connect over TCP. """
+    processes = sys.maxsize
+
+    def __init__(self, address, authkey, local_workers=0,
+                 patience=PATIENCE):
+        """ address: The (host, port) to listen on.
+            authkey: The key workers must have, as bytes.
+            local_workers: How many worker processes to start on this
+                machine once the cards are loaded (on the first call to
+                workers()), eg. for testing.
+            patience: Seconds map_multi waits without any workers before
+                it gives up on the remaining cards. """
+        self.address = address
+        self.authkey = authkey
+        self.local_workers = local_workers
+        self.patience = patience
+        # (conn, peer address, corpus key) of the workers not in use
+        self.idle = queue.Queue()
+        self.listener = multiprocessing.connection.Listener(
+                address, authkey=authkey)
+        # The local worker processes.
+        self.local = []
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        clog.info('Listening for card workers on {}:{}.'
+                  .format(*self.listener.address))
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except multiprocessing.AuthenticationError as e:
+                clog.warning('Refused a card worker: {}'.format(e))
+                continue
+            except OSError:
+                # The listener was closed.
+                return
+            peer = self.listener.last_accepted
+            try:
+                # Workers send their key as soon as they connect.
+                key = conn.recv() if conn.poll(_RETRY) else None
+            except (EOFError, OSError):
+                key = None
+            if key is None:
+                conn.close()
+                continue
+            self.idle.put((conn, '{}:{}'.format(*peer), key))
+
+    def _run_local(self):
+        """ Starts the local workers, or replaces those that died. """
+        host, port = self.listener.address
+        if host in ('', '0.0.0.0'):
+            host = '127.0.0.1'
+        args = ((host, port), self.authkey)
+        if self.local_workers:
+            self.local = [_start(serve, args)
+                          for _ in range(self.local_workers)]
+            self.local_workers = 0
+        else:
+            self.local = _replace_crashed(self.local, serve, args)
+
+    def workers(self, func, by_name, count, timeout=None):
+        """ Returns up to count of the connected workers not in use, started
+            on func with the given timeout per card. Workers whose cards
+            don't match are disconnected. """
+        self._run_local()
+        result = []
+        mykey = None
+        while len(result) < count:
+            try:
+                conn, peer, key = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            # The cards here may have changed since the last job, so this
+            # is checked every time a worker is handed out.
+            if mykey is None:
+                mykey = corpus_key()
+            if key != mykey:
+                clog.error('Card worker at {} has different cards; '
+                           'disconnecting it.'.format(peer))
+                try:
+                    conn.send(('reject', 'different cards'))
+                except (EOFError, OSError):
+                    pass
+                conn.close()
+                continue
+            w = _RemoteWorker(self, conn, peer, key)
+            if w.start(func, by_name, timeout):
+                result.append(w)
+        return result
+
+    def close(self):
+        self.listener.close()
+        while True:
+            try:
+                self.idle.get_nowait()[0].close()
+            except queue.Empty:
+                break
+        for p in self.local:
+            p.terminate()
+            p.join()
+
+def serve(address, authkey, wait=None):
+    """ Connects to a ClusterBackend at address and runs its jobs, connecting
+        again whenever the connection is lost. Gives up after wait seconds
+        without a connection, if wait is given. """
+    key = corpus_key()
+    since = time.monotonic()
+    while wait is None or time.monotonic() - since < wait:
+        try:
+            conn = multiprocessing.connection.Client(address,
+                                                     authkey=authkey)
+        except OSError:
+            time.sleep(_RETRY)
+            continue
+        try:
+            conn.send(key)
+            if not _run_jobs(conn):
+                return
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+        since = time.monotonic()
+
+def _run_jobs(conn):
+    """ Runs jobs until the connection closes, or returns False if the
+        backend rejects this worker. If a card takes more than the job's
+        timeout (plus _GRACE), the process exits. """
+    while True:
+        kind, *job = conn.recv()
+        if kind == 'reject':
+            clog.error('Rejected by the coordinator: {}.'.format(job[0]))
+            return False
+        func, by_name, timeout = job
+        clog.debug('Starting {}.'.format(func.__name__))
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            if timeout:
+                signal.signal(signal.SIGALRM, _timed_out(func, task))
+                signal.setitimer(signal.ITIMER_REAL, timeout + _GRACE)
+            try:
+                card.run_card_task(conn, func, task, by_name)
+            finally:
+                if timeout:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+
+def _timed_out(func, task):
+    """ Returns a signal handler that stops this worker process, for when
+        func takes too long on the card of task. """
+    def _handler(signum, frame):
+        clog.error('{} timed out on {}; exiting.'.format(func.__name__,
+                                                        task[1]))
+        # The parse can't be interrupted safely, and nothing is waiting
+        # for its result.
+        os._exit(1)
+    return _handler
+
+def run_workers(args):
+    """ Runs args.processes worker processes against the backend at
+        args.address until interrupted. The cards must already be loaded. """
+    authkey = get_authkey(args.authkey)
+    if not authkey:
+        print('An authkey is needed, with --authkey or ${}.'
+              .format(AUTHKEY_ENV), file=sys.stderr)
+        return 1
+    address = parse_address(args.address)
+    count = args.processes or os.cpu_count()
+    sargs = (address, authkey, args.wait)
+    processes = [_start(serve, sargs) for _ in range(count)]
+    print('Running {} card workers for {}.'.format(count, args.address))
+    try:
+        while processes:
+            time.sleep(_RETRY)
+            processes = _replace_crashed(processes, serve, sargs)
+    except KeyboardInterrupt:
+        for p in processes:
+            p.terminate()
+            p.join()
+    return 0
+
+def _start(target, args):
+    p = multiprocessing.Process(target=target, args=args, daemon=True)
+    p.start()
+    return p
+
+def _replace_crashed(processes, target, args):
+    """ Returns the processes still running, with new ones running
+        target(*args) in place of those that died, eg. crashing on a card.
+        Those that exited normally aren't replaced. """
+    result = []
+    for p in processes:
+        if p.is_alive():
+            result.append(p)
+        elif p.exitcode != 0:
+            result.append(_start(target, args))
+    return result
+
+def add_arguments(parser):
+    """ Adds the options for running map_multi's workers on a cluster to
+        the main parser. """
+    parser.add_argument('--cluster', metavar='HOST:PORT',
+        help='Listen on this address for card workers (see the worker '
+             'command) and send them the cards instead of using local '
+             'processes.')
+    parser.add_argument('--local-workers', type=int, default=0,
+        help='With --cluster, also start this many workers on this '
+             'machine.')
+    parser.add_argument('--authkey',
+        help='Key shared by the cluster and its workers. Defaults to ${}.'
+             .format(AUTHKEY_ENV))
+
+def backend_from_args(args):
+    """ Returns a ClusterBackend for the main parser's options, or None if
+        --cluster wasn't given. """
+    if not args.cluster:
+        return None
+    authkey = get_authkey(args.authkey)
+    if not authkey:
+        if not args.local_workers:
+            raise ValueError('--cluster needs an authkey, with --authkey '
+                             'or ${}.'.format(AUTHKEY_ENV))
+        authkey = os.urandom(16)
+    return ClusterBackend(parse_address(args.cluster), authkey,
+                          local_workers=args.local_workers)
+
+def add_subcommands(subparsers, func):
+    """ Adds the 'worker' command to the main parser, which will call
+        func with the parsed args. func should load the cards and then call
+        run_workers(args). subparsers should be the object returned by
+        add_subparsers() called on the main parser. """
+    subparser = subparsers.add_parser('worker',
+        description='Run card workers for a coordinator started with '
+                    '--cluster.')
+    subparser.add_argument('address', metavar='HOST:PORT',
+        help='Address of the coordinator.')
+    subparser.add_argument('--processes', type=int,
+        help='Number of worker processes. Defaults to the number of CPUs.')
+    subparser.add_argument('--wait', type=float,
+        help='Exit after this many seconds without a connection. '
+             'By default, keep trying.')
+    subparser.set_defaults(func=func)
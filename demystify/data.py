@@ -22,7 +22,10 @@ import datetime
 import json
 import logging
 import os
+import queue
+import re
 import shutil
+import threading
 import time
 import urllib.request
 
@@ -40,6 +43,8 @@ DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 ORACLE_JSON = "scryfall-oracle-cards.json"
 JSONCACHE = os.path.join(DATADIR, "cache", ORACLE_JSON)
 METADATA = os.path.join(DATADIR, "cache", "scryfall.metadata")
+NAMEREFS = os.path.join(DATADIR, "cache", "namerefs.json")
+CARDTIMES = os.path.join(DATADIR, "cache", "cardtimes.json")
 
 ## Scryfall Client ##
 
@@ -129,16 +134,102 @@ def maybe_download(filename=JSONCACHE):
 
 ## Loader ##
 
-def load(filename=JSONCACHE):
-    """ Load the cards from the Scryfall Oracle JSON file. """
-    if not maybe_download(filename):
+def _available(filename, update):
+    """ Makes sure the JSON file is there, downloading it if update is True
+        and it's out of date. Returns whether it can be loaded. """
+    if not update:
+        if not os.path.exists(filename):
+            ulog.critical("JSON file {} not found.".format(filename))
+            return False
+    elif not maybe_download(filename):
         if os.path.exists(filename):
             ulog.info("Falling back to existing JSON file.")
         else:
             ulog.critical("Failed to get JSON file.")
-            return {}
+            return False
+    return True
+
+def load(filename=JSONCACHE, update=True):
+    """ Load the cards from the Scryfall Oracle JSON file.
+        If update is False, the file is used as is, without checking
+        Scryfall for a newer one. """
+    if not _available(filename, update):
+        return {}
     with open(filename) as f:
         j = json.load(f)
     llog.debug("Loaded {} objects from {}.".format(len(j), filename))
     return j
 
+_CHUNK = 1 << 20
+_array_start = re.compile(r'\s*\[')
+_separators = re.compile(r'[\s,]*')
+
+def decode_array(f, chunk=_CHUNK):
+    """ Yields the elements of the JSON array in the file f one at a time,
+        each decoded as soon as enough of the file has been read. """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk)
+    m = _array_start.match(buf)
+    if not m:
+        raise ValueError('{} does not hold a JSON array.'
+                         .format(getattr(f, 'name', f)))
+    pos = m.end()
+    while True:
+        pos = _separators.match(buf, pos).end()
+        if pos < len(buf):
+            if buf[pos] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The element may go on past what has been read so far.
+                pass
+            else:
+                yield obj
+                pos = end
+                continue
+        more = f.read(chunk)
+        if not more:
+            if pos < len(buf):
+                # Decode again to raise the error.
+                decoder.raw_decode(buf, pos)
+            raise ValueError('Unterminated JSON array.')
+        buf = buf[pos:] + more
+        pos = 0
+
+_BATCH = 100
+
+def stream(filename=JSONCACHE, update=True):
+    """ As load, but yields the objects one at a time, as a thread reads
+        and decodes the file ahead of the caller, so the caller can start
+        on the first objects without waiting for the whole file. """
+    if not _available(filename, update):
+        return
+    # Lists of objects, then None at the end, or an exception.
+    q = queue.Queue(maxsize=64)
+    def _produce():
+        try:
+            with open(filename) as f:
+                batch = []
+                for obj in decode_array(f):
+                    batch.append(obj)
+                    if len(batch) == _BATCH:
+                        q.put(batch)
+                        batch = []
+                if batch:
+                    q.put(batch)
+            q.put(None)
+        except Exception as e:
+            q.put(e)
+    threading.Thread(target=_produce, daemon=True).start()
+    count = 0
+    while True:
+        batch = q.get()
+        if batch is None:
+            break
+        if isinstance(batch, Exception):
+            raise batch
+        count += len(batch)
+        yield from batch
+    llog.debug("Loaded {} objects from {}.".format(count, filename))
+
@@ -19,8 +19,12 @@
 """demystify -- A Magic: The Gathering parser."""
 
 import argparse
+import collections
+import io
 import logging
+import multiprocessing
 import re
+import sys
 
 logging.basicConfig(level=logging.DEBUG, filename="LOG", filemode="w")
 plog = logging.getLogger("Parser")
@@ -32,10 +36,22 @@ plog.addHandler(_stdout)
 
 import antlr3
 
+import arena
+import benchmark
 import card
+import cluster
 import data
+import failures
+import fastparse
 from grammar import DemystifyLexer, DemystifyParser
+import packedtree
+import parsecache
+import prepcache
+import ruleprof
+import server
+import store
 import test
+import treequery
 
 # What we don't handle:
 #   - physical interactions like dropping cards onto the table
@@ -134,49 +150,484 @@ def test_parse(rule, text, name=''):
     print(result.tree.toStringTree())
     return result
 
-def parse_all(cards):
-    """ Run the parser against each card's parseable parts. """
-    # card attribute -> parser rule
-    parts = { 'cost' : 'card_mana_cost',
-              'typeline' : 'typeline' }
-    errors = 0
-    for c in card.CardProgressBar(cards):
-        for part, rule in parts.items():
+_card_times = None
+
+# The card.map_multi backend, if not local processes (see main).
+_backend = None
+
+# The TextArena of the loaded cards' preprocessed text, which worker
+# processes inherit (see _open_arena).
+_arena = None
+# card name -> the card's rules string when the arena was opened, to tell
+# whether its text in the arena is still current.
+_arena_rules = {}
+
+def _rules_lines(c):
+    """ Returns the lines of a card's preprocessed rules text, sliced from
+        the arena if the arena has the card's current text. """
+    if _arena is not None and _arena_rules.get(c.name) is c.rules:
+        return _arena.card_lines(c.name)
+    return c.rules.split('\n')
+
+def _map_cards(func, cards):
+    """ Runs card.map_multi by name, handing out the cards that took the
+        longest in earlier runs first, and saves the new times (unless
+        _card_times has no file, as while benchmarking). """
+    global _card_times
+    if _card_times is None:
+        _card_times = card.CardTimes(data.CARDTIMES)
+    results = card.map_multi(func, cards, by_name=True, times=_card_times,
+                             backend=_backend)
+    if _card_times.filename:
+        _card_times.save()
+    return results
+
+# card attribute -> parser rule, for parse_all
+card_parts = {'cost': 'card_mana_cost',
+              'typeline': 'typeline'}
+
+def _parse_all(fast, profile, c):
+    """ The worker for parse_all. Returns a tuple (card name, list of parse
+        results as (part, text, packed tree, number of errors), error
+        clusters data, profiler data or None). """
+    bp = _get_batch_parser()
+    results = []
+    clusters = failures.FailureClusters()
+    prof = None
+    if profile:
+        prof = ruleprof.RuleProfiler()
+        prof.start()
+    try:
+        for part, rule in card_parts.items():
             a = getattr(c, part)
             if a:
-                p, parse_result = _parse(rule, a, c.name)
-                setattr(c, 'parsed_' + part, parse_result.tree)
-                if p.getNumberOfSyntaxErrors():
-                    plog.debug('result: ' + parse_result.tree.toStringTree())
-                    errors += 1
-    print('{} total errors.'.format(errors))
+                pt = fastparse.parse(rule, a) if fast else None
+                if pt is not None:
+                    results.append((part, a, pt, 0))
+                    continue
+                tree, e = bp.parse(rule, a, c.name)
+                if e:
+                    plog.debug('result: ' + tree.toStringTree())
+                    for case in failures.cases(bp.parser, tree):
+                        clusters.add(case, c.name, a)
+                results.append((part, a, packedtree.pack(tree), e))
+    finally:
+        if prof:
+            prof.stop()
+    return (c.name, results, clusters.data(), prof and prof.data())
+
+def parse_all(cards, profiler=None, store=None, index=None, fast=True):
+    """ Run the parser against each card's parseable parts, in parallel.
+        The results are saved to each card as PackedTrees, eg. in
+        c.parsed_cost and c.parsed_typeline.
+        If profiler is a RuleProfiler, per-rule stats are added to it.
+        If store is a ResultStore, the results are saved to it.
+        If index is a TreeIndex, the results are added to it.
+        If fast is True, parts that fastparse can handle skip the parser
+        (see check_fast_paths). """
+    errors = 0
+    clusters = failures.FailureClusters()
+    rows = {part: [] for part in card_parts}
+    plog.removeHandler(_stdout)
+    task = card.CardTask(_parse_all, fast, bool(profiler))
+    results = _map_cards(task, cards)
+    for cname, pc, u, pd in results:
+        c = card.get_card(cname)
+        for part, a, pt, e in pc:
+            setattr(c, 'parsed_' + part, pt)
+            if e:
+                errors += 1
+            if store:
+                rows[part].append((cname, None, a, pt, e))
+            if index is not None:
+                index.add((cname, part, None), pt)
+        clusters.merge(u)
+        if profiler:
+            profiler.merge(pd)
+    plog.addHandler(_stdout)
+    if store:
+        names = [c.name for c in cards]
+        for part, rule in card_parts.items():
+            store.add_results(part, rule, rows[part], cards=names)
+    _report_failures(errors, clusters)
+
+def _fast_path_items(c):
+    """ Yields (rule, text) for each part of the card, and each fragment of
+        its rules text in text_passes, whose rule has a fast path. """
+    for part, rule in card_parts.items():
+        a = getattr(c, part)
+        if a and rule in fastparse.rules:
+            yield rule, a
+    for _, rule, yesregex, noregex in text_passes:
+        if rule in fastparse.rules:
+            for line in _rules_lines(c):
+                for start, end in _spans(line, yesregex, noregex):
+                    yield rule, line[start:end]
+
+def _check_fast_paths(c):
+    """ The worker for check_fast_paths. Returns a tuple (number of texts
+        checked, list of mismatches). """
+    bp = _get_batch_parser()
+    checked = 0
+    mismatches = []
+    for rule, text in _fast_path_items(c):
+        pt = fastparse.parse(rule, text)
+        if pt is None:
+            continue
+        checked += 1
+        tree, e = bp.parse(rule, text, c.name)
+        expected = packedtree.pack(tree)
+        if e or pt != expected:
+            mismatches.append((c.name, rule, text, pt.toStringTree(),
+                               expected.toStringTree()))
+    return checked, mismatches
+
+def check_fast_paths(cards, limit=10):
+    """ Parses every part and rules text fragment of the cards that
+        fastparse handles with both fastparse and the parser, in parallel,
+        and reports every one where the trees differ or the parser found
+        errors.
+        Returns a list of (card name, rule, text, fast tree, parser tree)
+        for each mismatch. """
+    plog.removeHandler(_stdout)
+    results = _map_cards(_check_fast_paths, cards)
+    plog.addHandler(_stdout)
+    checked = sum(r[0] for r in results)
+    mismatches = [m for r in results for m in r[1]]
+    print('{} of {} fast path results differ from the parser.'
+          .format(len(mismatches), checked))
+    for name, rule, text, fast, slow in mismatches[:limit]:
+        print('{} ({}): {}\n    fast:   {}\n    parser: {}'
+              .format(name, rule, text, fast, slow))
+    for m in mismatches[limit:]:
+        plog.debug('Fast path mismatch: {}'.format(m))
+    return mismatches
+
+def _log_parse_errors(name, lineno, text, tree):
+    """ Logs the text and result tree of a parse that had errors. """
+    plog.debug('{}:{}:text:{}'.format(name, lineno, text))
+    plog.debug('{}:{}:result:{}'.format(name, lineno, tree.toStringTree()))
 
 def _crawl_tree_for_errors(name, lineno, text, tree):
     """ Common helper function for gathering errors.
         Logs error text and returns a unique error case for the
         first encountered error. """
-    plog.debug('{}:{}:text:{}'.format(name, lineno, text))
-    plog.debug('{}:{}:result:{}'.format(name, lineno, tree.toStringTree()))
-    queue = [tree]
-    while queue:
-        n = queue.pop(0)
-        if n.children:
-            queue.extend(n.children)
-        if isinstance(n, antlr3.tree.CommonErrorNode):
-            mstart = n.trappedException.token.start
-            mend = text.find(',', mstart)
-            if mend < 0:
-                mend = len(text)
-            mcase = text[mstart:mend]
-            if not mcase:
-                plog.warning('{}:{}:Empty case detected!'.format(name, lineno))
-            return mcase
-
-def parse_helper(cards, name, rulename, yesregex=None, noregex=None):
-    """ Parse a given subset of text on a given subset of cards.
+    _log_parse_errors(name, lineno, text, tree)
+    for n in failures.error_nodes(tree):
+        mstart = n.trappedException.token.start
+        mend = text.find(',', mstart)
+        if mend < 0:
+            mend = len(text)
+        mcase = text[mstart:mend]
+        if not mcase:
+            plog.warning('{}:{}:Empty case detected!'.format(name, lineno))
+        return mcase
+
+def _report_failures(errors, clusters, limit=10):
+    """ Prints the number of errors and the most common error clusters,
+        and logs all the clusters. """
+    print('{} total errors.'.format(errors))
+    if clusters:
+        print('{} error clusters.'.format(len(clusters)))
+        clusters.report(limit=limit)
+        out = io.StringIO()
+        clusters.report(out=out)
+        plog.debug('Error clusters:\n' + out.getvalue())
+
+## Batch parsing ##
+
+def _rebind(recognizer, stream):
+    """ Points a recognizer and all of its delegates (the recognizers for
+        imported grammars) at a new input stream, and resets their shared
+        state. """
+    recognizers = []
+    stack = [recognizer]
+    while stack:
+        r = stack.pop()
+        if any(r is q for q in recognizers):
+            continue
+        recognizers.append(r)
+        stack.extend(v for v in vars(r).values()
+                     if isinstance(v, antlr3.recognizers.BaseRecognizer))
+    # As in setTokenStream/setCharStream: reset without any input,
+    # so that the new stream isn't touched until it's used.
+    for r in recognizers:
+        r.input = None
+    recognizer.reset()
+    for r in recognizers:
+        r.input = stream
+
+class _TokenListSource(antlr3.TokenSource):
+    """ A token source that gives out a list of already-lexed tokens. """
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+
+    def nextToken(self):
+        return next(self.tokens, None) or antlr3.CommonToken(type=antlr3.EOF)
+
+    def getSourceName(self):
+        return 'tokens'
+
+def _token_bounds(tokens):
+    """ Returns dicts of the tokens' start positions and stop positions
+        to their indices in the list. """
+    return ({t.start: i for i, t in enumerate(tokens)},
+            {t.stop: i for i, t in enumerate(tokens)})
+
+def _slice_tokens(tokens, bounds, start, end):
+    """ Returns copies of the tokens that exactly cover text[start:end] of
+        the text they were lexed from, moved so that the fragment begins at
+        position 0, as if the fragment had been lexed on its own.
+        Returns None if the fragment doesn't begin and end on token
+        boundaries, in which case it must be lexed separately. """
+    starts, stops = bounds
+    i = starts.get(start)
+    j = stops.get(end - 1)
+    if i is None or j is None or j < i:
+        return None
+    result = []
+    for t in tokens[i:j+1]:
+        u = antlr3.CommonToken(oldToken=t)
+        # The text would otherwise be read from the original input
+        # at the moved positions.
+        u.text = t.text
+        u.start = t.start - start
+        u.stop = t.stop - start
+        u.charPositionInLine = t.charPositionInLine - start
+        result.append(u)
+    return result
+
+class BatchParser(object):
+    """ A lexer and parser pair that is reused for every fragment parsed,
+        instead of constructing a new pair (and all their delegates and
+        DFAs) each time. """
+    def __init__(self):
+        self.lexer = DemystifyLexer.DemystifyLexer(
+                antlr3.ANTLRStringStream(''))
+        self.parser = DemystifyParser.DemystifyParser(
+                antlr3.CommonTokenStream(self.lexer))
+
+    def lex(self, text, name=''):
+        """ Returns the list of tokens of text, including hidden ones. """
+        _rebind(self.lexer, antlr3.ANTLRStringStream(text))
+        self.lexer.card = name
+        return antlr3.CommonTokenStream(self.lexer).getTokens() or []
+
+    def parse(self, rule, text, name='', lineno=None):
+        """ Returns a pair (result tree, number of syntax errors). """
+        _rebind(self.lexer, antlr3.ANTLRStringStream(text))
+        self.lexer.card = name
+        return self._parse(rule, antlr3.CommonTokenStream(self.lexer),
+                           name, lineno)
+
+    def parse_tokens(self, rule, tokens, name='', lineno=None):
+        """ As parse, but for text that has already been lexed into
+            the given tokens, which should not include EOF. """
+        return self._parse(rule, antlr3.CommonTokenStream(
+                                     _TokenListSource(tokens)),
+                           name, lineno)
+
+    def _parse(self, rule, ts, name, lineno):
+        if lineno:
+            ts.line = lineno
+        _rebind(self.parser, ts)
+        self.parser.setCardState(name)
+        result = getattr(self.parser, rule)()
+        return result.tree, self.parser.getNumberOfSyntaxErrors()
+
+_batch_parser = None
+
+def _get_batch_parser():
+    """ Returns this process's BatchParser, creating it if necessary. """
+    global _batch_parser
+    if _batch_parser is None:
+        _batch_parser = BatchParser()
+    return _batch_parser
+
+_template_cache = None
+
+def _get_template_cache():
+    """ Returns this process's TemplateCache, creating it if necessary. """
+    global _template_cache
+    if _template_cache is None:
+        _template_cache = parsecache.TemplateCache(
+                [DemystifyParser.NUMBER_SYM, DemystifyParser.MANA_SYM,
+                 DemystifyParser.REFBYNAME])
+    return _template_cache
+
+# The result of parsing one fragment. tree is the result tree as a PackedTree,
+# and case is the unique error case (as in parse_helper) if there were errors.
+ParseResult = collections.namedtuple(
+        'ParseResult', 'name lineno text rule tree errors case')
+
+def parse_batch(items):
+    """ Parses many fragments in this process with a single lexer and
+        parser, and returns a list of ParseResults in the same order.
+
+        items: An iterable of (card, lineno, text, rule), where card is a
+            Card or card name and lineno may be None. """
+    bp = _get_batch_parser()
+    results = []
+    for c, lineno, text, rule in items:
+        name = getattr(c, 'name', c) or ''
+        tree, errors = bp.parse(rule, text, name, lineno)
+        case = None
+        if errors:
+            case = _crawl_tree_for_errors(name, lineno, text, tree)
+        results.append(ParseResult(name, lineno, text, rule,
+                                   packedtree.pack(tree), errors, case))
+    return results
+
+def parse_texts(rule, texts, name=''):
+    """ Parses each of texts with the given rule, as parse_batch. """
+    return parse_batch((name, None, text, rule) for text in texts)
+
+def _candidates(cards, yesregex=None, noregex=None):
+    """ Returns the set of cards that may have text to parse for the given
+        regexes, as described in parse_helper. """
+    if yesregex:
+        pattern = yesregex.pattern
+        if noregex:
+            return {card.get_card(c[0])
+                    for c in card.search_text(pattern, cards=cards)
+                    if not noregex.match(c[1])}
+        return {card.get_card(c[0])
+                for c in card.search_text(pattern, cards=cards)}
+    if noregex:
+        return {c for c in cards
+                if not all(noregex.match(line)
+                           for line in c.rules.split('\n'))}
+    return set(cards)
+
+def _spans(line, yesregex=None, noregex=None):
+    """ Returns the (start, end) spans of the text to parse in line. """
+    if yesregex:
+        spans = [m.span(1) if m.groups() else m.span(0)
+                 for m in yesregex.finditer(line)]
+    else:
+        spans = [(0, len(line))]
+    if noregex:
+        spans = [(s, e) for s, e in spans if not noregex.match(line[s:e])]
+    return spans
+
+def _parse_multi(applicable, fast, profile, c):
+    """ The worker for parse_multi, where applicable maps card names to
+        their specs. Returns a tuple (card name, dict of spec name to tuple
+        (list of parse results as (lineno, text, packed tree, number of
+        errors), number of errors, error clusters data), profiler data or
+        None). """
+    bp = _get_batch_parser()
+    tcache = _get_template_cache()
+    cspecs = applicable[c.name]
+    results = {name: ([], 0, failures.FailureClusters())
+               for name, _, _, _ in cspecs}
+    prof = None
+    if profile:
+        prof = ruleprof.RuleProfiler()
+        prof.start()
+    try:
+        for lineno, line in enumerate(_rules_lines(c)):
+            lineno += 1
+            tokens = None
+            for name, rulename, yesregex, noregex in cspecs:
+                rs, errors, clusters = results[name]
+                for start, end in _spans(line, yesregex, noregex):
+                    text = line[start:end]
+                    pt = fastparse.parse(rulename, text) if fast else None
+                    if pt is not None:
+                        rs.append((lineno, text, pt, 0))
+                        continue
+                    if tokens is None:
+                        tokens = bp.lex(line, c.name)
+                        bounds = _token_bounds(tokens)
+                    ftokens = _slice_tokens(tokens, bounds, start, end)
+                    if ftokens is None:
+                        ftokens = bp.lex(text, c.name)
+                    pt = tcache.get(rulename, ftokens) if fast else None
+                    if pt is not None:
+                        rs.append((lineno, text, pt, 0))
+                        continue
+                    tree, e = bp.parse_tokens(rulename, ftokens,
+                                              c.name, lineno)
+                    rs.append((lineno, text, packedtree.pack(tree), e))
+                    if e:
+                        _log_parse_errors(c.name, lineno, text, tree)
+                        for case in failures.cases(bp.parser, tree):
+                            clusters.add(case, c.name, text)
+                        errors += 1
+                    elif fast:
+                        tcache.add(rulename, ftokens, tree,
+                                   lambda ts: bp.parse_tokens(
+                                           rulename, ts, c.name, lineno))
+                results[name] = (rs, errors, clusters)
+    finally:
+        if prof:
+            prof.stop()
+    return (c.name,
+            {name: (rs, e, clusters.data())
+             for name, (rs, e, clusters) in results.items()},
+            prof and prof.data())
+
+def parse_multi(cards, specs, profiler=None, store=None, index=None,
+                fast=True):
+    """ Parse several subsets of text on the cards in a single pass.
+
+        Each card that any spec applies to is sent to a worker once, and
+        each of its lines is split and lexed once. Every applicable spec is
+        then run on the line, reusing the line's tokens for each fragment
+        that starts and ends on a token boundary. Fragments whose tokens
+        match a cached template (see parsecache) aren't parsed again.
+
+        cards: An iterable of cards to search for matching text, as in
+            parse_helper.
+        specs: A list of (name, rulename, yesregex, noregex), each as the
+            arguments of the same names to parse_helper.
+        profiler, store, index: As in parse_helper.
+        fast: As in parse_all. If False, the template cache isn't used
+            either. """
+    # card name -> the specs that apply to that card
+    applicable = collections.defaultdict(list)
+    for spec in specs:
+        for c in _candidates(cards, spec[2], spec[3]):
+            applicable[c.name].append(spec)
+    ccards = {card.get_card(cname) for cname in applicable}
+
+    plog.removeHandler(_stdout)
+    # list of (cardname, dict of spec name to (parse results,
+    #          number of errors, error clusters)), profiler data)
+    task = card.CardTask(_parse_multi, dict(applicable), fast,
+                         bool(profiler), name='_parse_{}'.format(
+                                 '_'.join(spec[0] for spec in specs)))
+    results = _map_cards(task, ccards)
+    errors = {spec[0]: 0 for spec in specs}
+    clusters = {spec[0]: failures.FailureClusters() for spec in specs}
+    rows = {spec[0]: [] for spec in specs}
+    for cname, cresults, pd in results:
+        c = card.get_card(cname)
+        for name, (pc, e, u) in cresults.items():
+            setattr(c, 'parsed_{}'.format(name), [r[2] for r in pc])
+            if store:
+                rows[name].extend((cname,) + r for r in pc)
+            if index is not None:
+                for lineno, _, pt, _ in pc:
+                    index.add((cname, name, lineno), pt)
+            errors[name] += e
+            clusters[name].merge(u)
+        if profiler:
+            profiler.merge(pd)
+    if store:
+        names = [c.name for c in cards]
+        for name, rulename, _, _ in specs:
+            store.add_results(name, rulename, rows[name], cards=names)
+    plog.addHandler(_stdout)
+    for name, _, _, _ in specs:
+        if len(specs) > 1:
+            print('{}:'.format(name))
+        _report_failures(errors[name], clusters[name])
 
-        This function may override some re flags on the
-        provided regex objects.
+def parse_helper(cards, name, rulename, yesregex=None, noregex=None,
+                 profiler=None, store=None, index=None):
+    """ Parse a given subset of text on a given subset of cards.
 
         cards: An iterable of cards to search for matching text. To save time,
             the provided regexes will be used to pare down this list to just
@@ -189,64 +640,15 @@ def parse_helper(cards, name, rulename, yesregex=None, noregex=None):
             group 0 (the entire match) otherwise. If not provided, use each
             line in its entirety.
         noregex: Any text found after considering yesregex (or its absence)
-            is skipped if it matches this regex. """
-    def _parse_helper(c):
-        """ Returns a pair (number of errors, set of unique errors). """
-        results = []
-        errors = 0
-        uerrors = set()
-        for lineno, line in enumerate(c.rules.split('\n')):
-            lineno += 1
-            if yesregex:
-                texts = [m.group(1) if m.groups() else m.group(0)
-                         for m in yesregex.finditer(line)]
-            else:
-                texts = [line]
-            if noregex:
-                texts = [text for text in texts if not noregex.match(text)]
-            for text in texts:
-                p, parse_result = _parse(rulename, text, c.name, lineno)
-                tree = parse_result.tree
-                results.append(tree)
-                if p.getNumberOfSyntaxErrors():
-                    mcase = _crawl_tree_for_errors(c.name, lineno, text, tree)
-                    if mcase:
-                        uerrors.add(mcase)
-                    errors += 1
-        return (c.name, [t.toStringTree() for t in results], errors, uerrors)
-    _parse_helper.__name__ = '_parse_{}'.format(name)
-
-    if yesregex:
-        pattern = yesregex.pattern
-        if noregex:
-            ccards = {card.get_card(c[0])
-                      for c in card.search_text(pattern, cards=cards)
-                      if not noregex.match(c[1])}
-        else:
-            ccards = {card.get_card(c[0])
-                      for c in card.search_text(pattern, cards=cards)}
-    elif noregex:
-        ccards = {c for c in cards
-                  if not all(noregex.match(line)
-                             for line in c.rules.split('\n'))}
-    else:
-        ccards = set(cards)
-
-    errors = 0
-    uerrors = set()
-    plog.removeHandler(_stdout)
-    # list of (cardname, parsed result trees, number of errors, set of errors)
-    results = card.map_multi(_parse_helper, ccards)
-    cprop = 'parsed_{}'.format(name)
-    for cname, pc, e, u in results:
-        setattr(card.get_card(cname), cprop, pc)
-        errors += e
-        uerrors |= u
-    plog.addHandler(_stdout)
-    print('{} total errors.'.format(errors))
-    if uerrors:
-        print('{} unique cases missing.'.format(len(uerrors)))
-        plog.debug('Missing cases: ' + '; '.join(sorted(uerrors)))
+            is skipped if it matches this regex.
+        profiler: If provided, a RuleProfiler to which the per-rule stats
+            from every worker are added.
+        store: If provided, a ResultStore in which to save the results,
+            replacing any earlier results of this pass for these cards.
+        index: If provided, a TreeIndex to add the results to, keyed by
+            (card name, name, line number). """
+    parse_multi(cards, [(name, rulename, yesregex, noregex)],
+                profiler=profiler, store=store, index=index)
 
 # All costs come before a colon, but these may occur at the start of a line,
 # after an mdash, or after an opening quote for an ability.
@@ -262,46 +664,140 @@ levels = re.compile(r'^{level')
 # or sentence.
 triggerregex = re.compile(r"""(?:^|— | "| '|\. )when(?:ever)? ([^,]*),""")
 
-def parse_ability_costs(cards):
+# The parse passes over rules text, as (name, rulename, yesregex, noregex).
+cost_pass = ('costs', 'cost', costregex, levels)
+keyword_pass = ('keywords', 'keywords', None, keywordskipregex)
+trigger_pass = ('triggers', 'triggers', triggerregex, levels)
+text_passes = [cost_pass, keyword_pass, trigger_pass]
+
+def parse_ability_costs(cards, profiler=None, store=None, index=None):
     """ Find all ability costs in the cards and attempt to parse them. """
-    parse_helper(cards, 'costs', 'cost', yesregex=costregex, noregex=levels)
+    parse_multi(cards, [cost_pass], profiler=profiler, store=store,
+                index=index)
 
-def parse_keyword_lines(cards):
+def parse_keyword_lines(cards, profiler=None, store=None, index=None,
+                        fast=True):
     """ Parse all lines in the cards that are lists of keywords. """
-    parse_helper(cards, 'keywords', 'keywords', noregex=keywordskipregex)
+    parse_multi(cards, [keyword_pass], profiler=profiler, store=store,
+                index=index, fast=fast)
 
-def parse_triggers(cards):
+def parse_triggers(cards, profiler=None, store=None, index=None):
     """ Parse all trigger conditions in the cards. """
-    parse_helper(cards, 'triggers', 'triggers', yesregex=triggerregex,
-                 noregex=levels)
+    parse_multi(cards, [trigger_pass], profiler=profiler, store=store,
+                index=index)
 
-def preprocess(args):
-    raw_cards = []
-    for obj in data.load():
+def parse_rules_text(cards, profiler=None, store=None, index=None,
+                     fast=True):
+    """ Run all of the above passes over the cards at once. """
+    parse_multi(cards, text_passes, profiler=profiler, store=store,
+                index=index, fast=fast)
+
+def store_all(cards, filename=store.STOREFILE):
+    """ Run every parse pass over the cards and save the results to the
+        SQLite database at filename. Returns the ResultStore. """
+    rs = store.ResultStore(filename)
+    parse_all(cards, store=rs)
+    parse_rules_text(cards, store=rs)
+    return rs
+
+def tree_index():
+    """ Returns an empty TreeIndex that knows the parser's token names. """
+    return treequery.TreeIndex(getattr(DemystifyParser, 'tokenNames', None))
+
+def index_store(rs, **kwargs):
+    """ Returns a TreeIndex of the results in a ResultStore that match
+        the criteria of ResultStore.find, keyed by (card name, pass name,
+        line number). """
+    index = tree_index()
+    for r in rs.find(**kwargs):
+        index.add((r.card, r.pass_, r.lineno), r.tree)
+    return index
+
+def profile_rules(cards, report='ruleprof.tsv', collapsed='ruleprof.folded',
+                  sort='selftime', limit=20):
+    """ Run every parse pass over the cards with per-rule profiling,
+        print the top rules by the given column, and write the full
+        report and a collapsed stack file (for flamegraph.pl).
+        Returns the RuleProfiler. """
+    profiler = ruleprof.RuleProfiler()
+    parse_all(cards, profiler=profiler, fast=False)
+    parse_rules_text(cards, profiler=profiler, fast=False)
+    profiler.report(sort=sort, limit=limit)
+    if report:
+        profiler.write_report(report)
+    if collapsed:
+        profiler.write_collapsed(collapsed)
+    return profiler
+
+def construct_cards(objs):
+    """ Constructs Cards from the given Scryfall objects, keeping only
+        vintage-legal non-tokens. Returns the number of objects used. """
+    numcards = 0
+    for obj in objs:
         # filter down to vintage-legal only
         if obj["legalities"]["vintage"] == "legal" and "token" not in obj["layout"]:
-            raw_cards.append(obj)
+            numcards += 1
             _ = card.scryfall_card(**obj)
-    numcards = len(raw_cards)
-    if numcards == 0:
-        plog.error("No cards found.")
-        return 1
+    return numcards
+
+def load_cards(objs, cache=None):
+    """ Constructs and preprocesses Cards from the given Scryfall objects
+        as they come, eg. from data.stream, keeping only vintage-legal
+        non-tokens. Each card is preprocessed as soon as every name its text
+        refers to is known (see card.preprocess_early), and the rest once
+        every card is constructed. Returns the number of objects used.
+
+        cache: As in card.preprocess_all. """
+    numcards = 0
+    early = 0
+    # name -> the cards waiting for the name to be known
+    waiting = collections.defaultdict(list)
+    def _try(c):
+        nonlocal early
+        name = card.preprocess_early(c, cache)
+        if name is None:
+            early += 1
+        else:
+            waiting[name].append(c)
+
+    print("Loading and processing cards...")
+    for obj in objs:
+        # filter down to vintage-legal only
+        if (obj["legalities"]["vintage"] == "legal"
+                and "token" not in obj["layout"]):
+            numcards += 1
+            for c in card.scryfall_card(**obj):
+                if c.name not in BANNED:
+                    _try(c)
+                for w in waiting.pop(c.name, ()):
+                    _try(w)
+    late = [c for cs in waiting.values() for c in cs]
+    logging.info("{} cards preprocessed while loading, {} waiting on "
+                 "names that aren't cards.".format(early, len(late)))
+    for c in card.CardProgressBar(late):
+        card.preprocess_card(c, cache)
+    if cache:
+        cache.flush()
+        print("{} cards preprocessed, {} from the cache."
+              .format(early + len(late), cache.hits))
+    return numcards
+
+def check_cards(numcards, validate=True):
+    """ Cross-checks the multicards among the constructed cards,
+        and logs what was found.
+        If validate is False, eg. for a trusted snapshot, the multicards
+        are only counted (see card.validate_cards). """
     cards = card.get_cards()
-    split = {c.name for c in cards if c.multitype == "split"}
-    xsplit = {c.multicard for c in cards if c.multitype == "split"}
+    if validate:
+        faces = card.validate_cards()
+    else:
+        faces = card.multicards()
+    split = faces.get("split", set())
+    flip = faces.get("flip", set())
+    trans = faces.get("transform", set())
     logging.debug("Split cards: " + "; ".join(sorted(split)))
-    if split != xsplit:
-        logging.error("Difference: " + "; ".join(split ^ xsplit))
-    flip = {c.name for c in cards if c.multitype == "flip"}
-    xflip = {c.multicard for c in cards if c.multitype == "flip"}
     logging.debug("Flip cards: " + "; ".join(sorted(flip)))
-    if flip != xflip:
-        logging.error("Difference: " + "; ".join(flip ^ xflip))
-    trans = {c.name for c in cards if c.multitype == "transform"}
-    xtrans = {c.multicard for c in cards if c.multitype == "transform"}
     logging.debug("Transform cards: " + "; ".join(sorted(trans)))
-    if trans != xtrans:
-        logging.error("Difference: " + "; ".join(trans ^ xtrans))
     s = int(len(split) / 2)
     f = int(len(flip) / 2)
     t = int(len(trans) / 2)
@@ -313,23 +809,231 @@ def preprocess(args):
     if len(cards) - len(legalcards) != len(BANNED):
         logging.warning("...but {} banned cards were named."
                         .format(len(BANNED)))
-    card.preprocess_all(legalcards)
+
+def _open_arena(cards):
+    """ Opens the arena file of the cards' preprocessed text as _arena,
+        writing it first unless it already holds the same text, eg. after
+        a restart. """
+    global _arena, _arena_rules
+    if _arena is not None:
+        _arena.close()
+        _arena = None
+    _arena_rules = {}
+    key = cluster.corpus_key(cards)
+    try:
+        _arena = arena.TextArena()
+    except (OSError, ValueError):
+        pass
+    if _arena is None or _arena.key != key:
+        if _arena is not None:
+            _arena.close()
+        arena.write(arena.ARENAFILE, cards, key=key)
+        _arena = arena.TextArena()
+    # Preprocessing gives a card a new rules string, after which its text
+    # is read from the card again.
+    _arena_rules = {c.name: c.rules for c in cards}
+
+def load_corpus(validate=True):
+    """ Loads, constructs and preprocesses the cards.
+        Returns False if no cards were found.
+        validate: As in check_cards. """
+    cache = prepcache.PreprocessCache()
+    numcards = load_cards(data.stream(), cache=cache)
+    if numcards == 0:
+        plog.error("No cards found.")
+        cache.close()
+        return False
+    check_cards(numcards, validate=validate)
+    cards = get_cards()
+    cache.compact(c.name for c in cards)
+    cache.close()
+    card.save_name_refs(data.NAMEREFS)
+    _open_arena(cards)
+    return True
+
+def reprocess(names):
+    """ Redoes preprocessing and parsing for only the cards affected by a
+        change to the cards or tokens with the given names, eg. after their
+        oracle text was updated, and updates the preprocess cache, the
+        saved name reference graph and the arena to match.
+        Returns the set of affected cards. """
+    cards = card.affected_cards(names)
+    cache = prepcache.PreprocessCache()
+    card.preprocess_all(cards, cache=cache)
+    cache.close()
+    card.save_name_refs(data.NAMEREFS)
+    _open_arena(get_cards())
+    parse_all(cards)
+    parse_rules_text(cards)
+    return cards
+
+def preprocess(args):
+    if not load_corpus(validate=not args.no_validate):
+        return 1
     if args.interactive:
         import code
         code.interact(local=globals())
 
+def run_workers(args):
+    """ Main entry point for the 'worker' subcommand. """
+    # The cards must match the coordinator's, which has checked them.
+    if not load_corpus(validate=False):
+        return 1
+    plog.removeHandler(_stdout)
+    return cluster.run_workers(args)
+
+def check_fast(args):
+    """ Main entry point for the 'check' subcommand. """
+    if not load_corpus():
+        return 1
+    return 1 if check_fast_paths(get_cards()) else 0
+
+## Parse server ##
+
+def _serve_result(r):
+    d = r._asdict()
+    d['tree'] = r.tree.toStringTree()
+    return d
+
+def _serve_parse(rule, texts, name=''):
+    return [_serve_result(r) for r in parse_texts(rule, texts, name)]
+
+def _serve_parse_batch(items):
+    return [_serve_result(r) for r in parse_batch(items)]
+
+def _serve_parse_card(name):
+    c = card.get_card(name)
+    if not c:
+        raise KeyError('No such card: {}'.format(name))
+    # The same parts and passes as parse_all and parse_rules_text.
+    items = []
+    for part, rule in card_parts.items():
+        a = getattr(c, part)
+        if a:
+            items.append((c.name, None, a, rule))
+    for _, rule, yesregex, noregex in text_passes:
+        for lineno, line in enumerate(_rules_lines(c)):
+            items.extend((c.name, lineno + 1, line[start:end], rule)
+                         for start, end in _spans(line, yesregex, noregex))
+    return {'name': c.name, 'rules': c.rules,
+            'results': [_serve_result(r) for r in parse_batch(items)]}
+
+def _serve_search(regex, cards=None):
+    if cards:
+        cards = [card.get_card(cname) for cname in cards]
+    return card.search_text(regex, cards=cards)
+
+_serve_handlers = {
+    'parse': _serve_parse,
+    'parse_batch': _serve_parse_batch,
+    'parse_card': _serve_parse_card,
+    'search': _serve_search,
+}
+
+def serve(args):
+    """ Main entry point for the 'serve' subcommand.
+        args is a Namespace object with the appropriate flags. """
+    if not load_corpus():
+        return 1
+    plog.removeHandler(_stdout)
+    # Each worker builds its lexer and parser as it starts, so that no
+    # request waits for them.
+    server.run(args, _serve_handlers, initializer=_get_batch_parser)
+
+# Representative searches for benchmarking.
+_bench_searches = [
+    r'\bdraws? (a|two|three) cards?',
+    r'enters the battlefield',
+    r'sacrifice (a|an|another) \w+',
+    r'\bnamed NAME_',
+    costregex.pattern,
+    triggerregex.pattern,
+]
+
+def _bench_load_pipelined(snapshot):
+    return load_cards(data.stream(snapshot, update=False))
+
+def run_benchmarks(args):
+    """ Main entry point for the 'benchmark' subcommand.
+        args is a Namespace object with the appropriate flags. """
+    global _card_times
+    # Hand out the cards by the length of their text alone, so that
+    # the times recorded by earlier runs don't change the results.
+    _card_times = card.CardTimes()
+    state = {}
+    def load_json():
+        state['objs'] = data.load(args.snapshot, update=False)
+        return len(state['objs'])
+    def construct():
+        numcards = construct_cards(state.pop('objs'))
+        check_cards(numcards)
+        state['cards'] = get_cards()
+        return len(state['cards'])
+    def preprocess_all():
+        card.preprocess_all(state['cards'])
+        return len(state['cards'])
+    def load_pipelined():
+        # The same three steps as below, overlapped. This runs first, in a
+        # child process, so that no names are known yet as in a real load,
+        # and the cards it makes don't affect the other workloads.
+        with multiprocessing.Pool(1) as pool:
+            return pool.apply(_bench_load_pipelined, (args.snapshot,))
+    def run_pass(func):
+        def _run_pass():
+            func(state['cards'])
+            return len(state['cards'])
+        return _run_pass
+    def search():
+        for s in _bench_searches:
+            card.search_text(s, cards=state['cards'])
+        return len(state['cards']) * len(_bench_searches)
+    workloads = [
+        ('load_pipelined', load_pipelined),
+        ('load_json', load_json),
+        ('construct', construct),
+        ('preprocess_all', preprocess_all),
+        ('test_lex', run_pass(test_lex)),
+        ('parse_all', run_pass(parse_all)),
+        ('parse_ability_costs', run_pass(parse_ability_costs)),
+        ('parse_keyword_lines', run_pass(parse_keyword_lines)),
+        ('parse_triggers', run_pass(parse_triggers)),
+        ('parse_rules_text', run_pass(parse_rules_text)),
+        ('search_text', search),
+    ]
+    return benchmark.run(args, workloads)
+
 def main():
+    global _backend
     parser = argparse.ArgumentParser(
         description='A Magic: the Gathering parser.')
+    cluster.add_arguments(parser)
     subparsers = parser.add_subparsers()
     test.add_subcommands(subparsers)
     loader = subparsers.add_parser('load')
     loader.add_argument('-i', '--interactive', action='store_true',
                         help='Enter interactive mode instead of exiting.')
+    loader.add_argument('--no-validate', action='store_true',
+                        help="Don't check the multicard relationships, "
+                             "eg. for a card file already checked.")
     loader.set_defaults(func=preprocess)
+    checker = subparsers.add_parser(
+        'check', help='Check the fast paths against the parser over the '
+                      'whole corpus.')
+    checker.set_defaults(func=check_fast)
+    benchmark.add_subcommands(subparsers, run_benchmarks)
+    server.add_subcommands(subparsers, serve)
+    cluster.add_subcommands(subparsers, run_workers)
 
     args = parser.parse_args()
-    args.func(args)
+    try:
+        _backend = cluster.backend_from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        sys.exit(args.func(args))
+    finally:
+        if _backend:
+            _backend.close()
 
 if __name__ == '__main__':
     main()
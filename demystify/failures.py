@@ -0,0 +1,137 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""failures -- Clustering of parse failures into error cases.
+
+Each syntax error is keyed by the rule invocation stack at the point of the
+error, the type of the offending token, and the token types around it, so
+that lines failing in the same way group together regardless of the words
+(names, numbers, card types) involved.
+"""
+
+import collections
+import sys
+
+import antlr3
+import antlr3.tree
+
+# Tokens of context to keep before and after the offending token.
+BEFORE = 1
+AFTER = 2
+
+# One cluster of errors. stack is a tuple of rule names, token is the
+# offending token's type name, and ngram is a tuple of the type names of the
+# tokens around it.
+ErrorCase = collections.namedtuple('ErrorCase', 'stack token ngram')
+
+def error_nodes(tree):
+    """ Yields the error nodes of a tree, breadth-first. """
+    queue = collections.deque([tree])
+    while queue:
+        n = queue.popleft()
+        if n.children:
+            queue.extend(n.children)
+        if isinstance(n, antlr3.tree.CommonErrorNode):
+            yield n
+
+def _type_name(names, t):
+    if t == antlr3.EOF:
+        return 'EOF'
+    if names and 0 <= t < len(names):
+        return names[t]
+    return str(t)
+
+def _ngram(names, tokens, token):
+    """ Returns the type names of the on-channel tokens around token. """
+    if token is None or token.index < 0 or token.index >= len(tokens):
+        return ()
+    i = token.index
+    before = []
+    j = i - 1
+    while j >= 0 and len(before) < BEFORE:
+        if tokens[j].channel == antlr3.DEFAULT_CHANNEL:
+            before.append(_type_name(names, tokens[j].type))
+        j -= 1
+    after = []
+    j = i + 1
+    while j < len(tokens) and len(after) < AFTER:
+        if tokens[j].channel == antlr3.DEFAULT_CHANNEL:
+            after.append(_type_name(names, tokens[j].type))
+        j += 1
+    return (tuple(reversed(before)) + (_type_name(names, token.type),)
+            + tuple(after))
+
+def cases(parser, tree):
+    """ Returns the ErrorCases for the last parse made by parser, which
+        produced tree.
+
+        The rule invocation stacks are those recorded by the parser as it
+        reported each error (see setCardState in Demystify.g). If there are
+        none, the error nodes of the tree are used instead, without stacks. """
+    names = getattr(parser, 'tokenNames', None)
+    tokens = parser.input.getTokens() or []
+    recorded = getattr(parser._state, 'error_stacks', None)
+    if not recorded:
+        recorded = [((), n.trappedException.token)
+                    for n in error_nodes(tree)]
+    result = []
+    for stack, token in recorded:
+        name = _type_name(names, token.type) if token is not None else None
+        result.append(ErrorCase(tuple(stack), name,
+                                _ngram(names, tokens, token)))
+    return result
+
+class FailureClusters(object):
+    """ Counts of errors per ErrorCase, with a few example cards each. """
+    def __init__(self, examples=3):
+        self.examples_per_case = examples
+        self.counts = collections.Counter()
+        # ErrorCase -> list of (card name, text)
+        self.examples = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, case, name, text):
+        self.counts[case] += 1
+        ex = self.examples.setdefault(case, [])
+        if len(ex) < self.examples_per_case:
+            ex.append((name, text))
+
+    def data(self):
+        """ Returns the clusters in a form that can be pickled cheaply
+            and passed to merge(). """
+        return [(tuple(case), n, self.examples[case])
+                for case, n in self.counts.items()]
+
+    def merge(self, data):
+        """ Adds in the clusters from another FailureClusters' data(). """
+        for case, n, ex in data:
+            case = ErrorCase(*case)
+            self.counts[case] += n
+            mine = self.examples.setdefault(case, [])
+            mine.extend(ex[:self.examples_per_case - len(mine)])
+
+    def report(self, limit=None, out=sys.stdout):
+        """ Prints the clusters, most common first. """
+        for case, n in self.counts.most_common(limit):
+            print('{:6d} {} at {} [{}]'
+                  .format(n, case.token, ' > '.join(case.stack) or '?',
+                          ' '.join(case.ngram)), file=out)
+            for name, text in self.examples[case]:
+                print('           {}: {}'.format(name, text), file=out)
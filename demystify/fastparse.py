@@ -0,0 +1,242 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""fastparse -- Hand-written parsers for the simplest parser rules.
+
+Mana costs, type lines and lists of keywords without arguments are regular,
+and nearly all of them can be read with a regex and a few table lookups.
+Each function here returns the same PackedTree the grammar rule would
+produce, or None if the text is anything out of the ordinary, in which case
+the text must go to the parser.
+The tables are made from the same sources as the grammar: the symbols of
+Symbols.g, the words of keywords.py that Words.g and macro.g are generated
+from, and the keyword lists of raw_keywords.g.
+"""
+
+import os
+import re
+import sys
+
+from grammar import DemystifyParser
+import keywords
+from packedtree import PackedTree
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'deps'))
+import deps
+
+_grammar_dir = os.path.join(os.path.dirname(__file__), 'grammar')
+
+def _type(name):
+    return getattr(DemystifyParser, name)
+
+def _imaginary(name, children):
+    return (_type(name), children, name)
+
+def rule_alternatives(filename, rule):
+    """ Returns the alternatives of a parser rule in a grammar file,
+        as strings, eg. ['DEATHTOUCH', 'DEFENDER', 'double_strike', ...]. """
+    with open(os.path.join(_grammar_dir, filename)) as g:
+        text = deps.comments.sub(' ', g.read())
+    m = re.search(r'^{}\s*:(.*?);'.format(rule), text, re.M | re.S)
+    if not m:
+        raise ValueError('No rule {} in {}'.format(rule, filename))
+    return [' '.join(alt.split()) for alt in m.group(1).split('|')]
+
+def word_token(word):
+    """ Returns the name of the token the lexer makes of word, or None if
+        it isn't a word of Words.g by itself. """
+    if word in keywords.all_words:
+        return keywords.all_words[word]
+    for token, words in keywords.macro_tokens.items():
+        if word in words:
+            return token
+    return None
+
+## Mana costs ##
+
+# MANA_SYM and VAR_MANA_SYM of Symbols.g. Anything else in a cost, such as
+# whitespace, {p} on its own or three-digit numbers, goes to the parser.
+_mana_sym = re.compile(r'\{(?:([wubrgcs]|[1-9][0-9]|[0-9])(/[wubrgcp])?'
+                       r'|([xyz]))\}')
+
+def parse_mana_cost(text):
+    """ As the card_mana_cost rule: (COST (MANA syms... (VAR X)...)). """
+    syms = []
+    var_syms = []
+    pos = 0
+    while pos < len(text):
+        m = _mana_sym.match(text, pos)
+        if not m:
+            return None
+        if m.group(3):
+            var_syms.append(m.group(3).upper())
+        else:
+            syms.append(m.group(0)[1:-1].upper())
+        pos = m.end()
+    if not syms and not var_syms:
+        return None
+    nodes = [_imaginary('COST', 1),
+             _imaginary('MANA', len(syms) + len(var_syms))]
+    mana_sym = _type('MANA_SYM')
+    nodes.extend((mana_sym, 0, s) for s in syms)
+    var_mana_sym = _type('VAR_MANA_SYM')
+    for s in var_syms:
+        nodes.append(_imaginary('VAR', 1))
+        nodes.append((var_mana_sym, 0, s))
+    return PackedTree.from_nodes(nodes)
+
+## Type lines ##
+
+_supertypes = {'BASIC', 'LEGENDARY', 'SNOW', 'WORLD', 'ONGOING'}
+_noncreature_perm_types = {'ARTIFACT', 'ENCHANTMENT', 'LAND', 'PLANESWALKER'}
+_permanent_types = _noncreature_perm_types | {'CREATURE'}
+_spell_types = {'INSTANT', 'SORCERY'}
+_other_types = {'PLANE', 'SCHEME', 'VANGUARD'}
+
+def _subtype_tokens():
+    """ Returns the token names that obj_subtype (in macro.g) matches on
+        their own. """
+    return {opt for opt in keywords.macro_rules['obj_subtype']
+            if ' ' not in opt}
+
+# word -> token name, for the words of keywords.types that can appear in
+# the types of a type line.
+_type_words = {w: t for w, t in keywords.types.items()
+               if word_token(w) == t
+               and t in (_supertypes | _permanent_types | _spell_types
+                         | _other_types | {'TRIBAL'})}
+
+# word -> token name, for the subtypes of keywords.subtypes that are lexed
+# as a single token matched by obj_subtype. Multi-word subtypes, and those
+# with apostrophes or hyphens, are left to the parser.
+_subtype_words = {}
+for _w in keywords.subtypes:
+    if _w.isalpha() and word_token(_w) in _subtype_tokens():
+        _subtype_words[_w] = word_token(_w)
+del _w
+
+_ws = re.compile(r'[ \t\n]+')
+
+def _types_ok(ts):
+    """ Returns whether the list of type token names matches the types rule
+        exactly. """
+    if not ts:
+        return False
+    if ts[0] == 'TRIBAL':
+        rest = ts[1:]
+        return (len(rest) == 1 and rest[0] in _spell_types
+                or bool(rest) and all(t in _noncreature_perm_types
+                                      for t in rest))
+    if len(ts) == 1 and (ts[0] in _spell_types or ts[0] in _other_types):
+        return True
+    return all(t in _permanent_types for t in ts)
+
+def parse_typeline(text):
+    """ As the typeline rule:
+        (TYPELINE (SUPERTYPES ...) (TYPES ...) (SUBTYPES ...)). """
+    words = _ws.split(text.strip(' \t\n'))
+    if '—' in words:
+        i = words.index('—')
+    elif '--' in words:
+        i = words.index('--')
+    else:
+        i = len(words)
+    main, subs = words[:i], words[i+1:]
+    if i < len(words) and not subs:
+        return None
+    supers = []
+    types = []
+    for w in main:
+        t = _type_words.get(w)
+        if t is None:
+            return None
+        if t in _supertypes and not types:
+            supers.append((w, t))
+        else:
+            types.append((w, t))
+    if not _types_ok([t for _, t in types]):
+        return None
+    subtypes = []
+    for w in subs:
+        t = _subtype_words.get(w)
+        if t is None:
+            return None
+        subtypes.append((w, t))
+    nodes = [_imaginary('TYPELINE',
+                        1 + bool(supers) + bool(subtypes))]
+    for name, group in (('SUPERTYPES', supers), ('TYPES', types),
+                        ('SUBTYPES', subtypes)):
+        if group:
+            nodes.append(_imaginary(name, len(group)))
+            nodes.extend((_type(t), 0, w) for w, t in group)
+    return PackedTree.from_nodes(nodes)
+
+## Keyword lines ##
+
+def _no_arg_keywords():
+    """ Returns a dict of phrase -> (token name, node text) for each
+        keyword in raw_keyword_no_args. Keywords lexed as one token are
+        nodes of that token with the phrase as text; keywords made of
+        several tokens by a macro rule (eg. first_strike) are imaginary
+        nodes of the macro's token. """
+    table = {}
+    for alt in rule_alternatives('raw_keywords.g', 'raw_keyword_no_args'):
+        if alt.isupper():
+            for w, t in keywords.abilities.items():
+                if t == alt and word_token(w) == t:
+                    table[w] = (t, w)
+        elif alt in keywords.macro_rules:
+            for opt in keywords.macro_rules[alt]:
+                if ' -> ' not in opt:
+                    continue
+                t = opt.split(' -> ')[1]
+                for phrase, r in keywords.replaced.items():
+                    if r == t:
+                        table[phrase] = (t, t)
+    return table
+
+_keyword_phrases = _no_arg_keywords()
+
+_keyword_sep = re.compile(r'[,;]')
+
+def parse_keywords(text):
+    """ As the keywords rule, for lines that are only keywords without
+        arguments separated by commas or semicolons:
+        (KEYWORDS flying FIRST_STRIKE ...). """
+    nodes = []
+    for item in _keyword_sep.split(text):
+        k = _keyword_phrases.get(item.strip(' \t\n'))
+        if k is None:
+            return None
+        nodes.append((_type(k[0]), 0, k[1]))
+    nodes.insert(0, _imaginary('KEYWORDS', len(nodes)))
+    return PackedTree.from_nodes(nodes)
+
+# parser rule -> fast parse function
+rules = {
+    'card_mana_cost': parse_mana_cost,
+    'typeline': parse_typeline,
+    'keywords': parse_keywords,
+}
+
+def parse(rule, text):
+    """ Returns the PackedTree for text under the given parser rule,
+        or None if there is no fast path for the rule or the text. """
+    func = rules.get(rule)
+    return func(text) if func else None
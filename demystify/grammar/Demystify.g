@@ -119,6 +119,10 @@ tokens {
                            .format(e))
                 else:
                     msg = supermethod(self, e)
+                # kept for clustering failures; see failures.cases
+                errors = getattr(self._state, 'error_stacks', None)
+                if errors is not None:
+                    errors.append((tuple(stack), e.token))
                 return "{} {}".format(stack, msg)
             return _getErrorMessage
 
@@ -181,6 +185,7 @@ tokens {
 @parser::members {
     def setCardState(self, name):
         self._state.card = name
+        self._state.error_stacks = []
 }
 
 card_mana_cost : mana -> ^( COST mana );
@@ -0,0 +1,198 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""packedtree -- Compact, array-backed parse trees.
+
+A PackedTree stores a tree in preorder as a single bytes object of unsigned
+16-bit triples: the token type of each node, the number of children of each
+node, and the index of each node's text in a small table of unique strings.
+These are much smaller than CommonTree objects or their string forms, cheap
+to pickle, and can be turned back into either on demand.
+"""
+
+import array
+import sys
+
+# Text of a nil node, ie. a node without a token.
+NIL = None
+
+def _unpickle(data, strings):
+    # Most texts repeat across trees (eg. SUBSET), so share them.
+    return PackedTree(data, tuple(s if s is None else sys.intern(s)
+                                  for s in strings))
+
+class PackedTree(object):
+    __slots__ = ('data', 'strings')
+
+    def __init__(self, data, strings):
+        self.data = data
+        self.strings = strings
+
+    @classmethod
+    def pack(cls, tree):
+        """ Packs an antlr3 tree (or anything with the same interface). """
+        data = array.array('H')
+        table = {}
+        stack = [tree]
+        while stack:
+            n = stack.pop()
+            children = n.children
+            # toString gives the text used by toStringTree, including
+            # for error nodes.
+            text = NIL if n.isNil() else n.toString()
+            if text not in table:
+                table[text] = len(table)
+            data.extend((n.getType(), len(children), table[text]))
+            stack.extend(reversed(children))
+        strings = [None] * len(table)
+        for text, i in table.items():
+            strings[i] = text
+        return cls(data.tobytes(), tuple(strings))
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """ Makes a PackedTree of nodes given in preorder as
+            (token type, number of children, text), with the string table
+            in order of first appearance, as pack makes it. """
+        data = array.array('H')
+        table = {}
+        for t, c, text in nodes:
+            if text not in table:
+                table[text] = len(table)
+            data.extend((t, c, table[text]))
+        return cls(data.tobytes(), tuple(table))
+
+    def __reduce__(self):
+        return (_unpickle, (self.data, self.strings))
+
+    @property
+    def types(self):
+        return memoryview(self.data).cast('H')[0::3]
+
+    @property
+    def counts(self):
+        return memoryview(self.data).cast('H')[1::3]
+
+    @property
+    def texts(self):
+        return memoryview(self.data).cast('H')[2::3]
+
+    def __len__(self):
+        return len(self.data) // 6
+
+    def __eq__(self, other):
+        return (isinstance(other, PackedTree)
+                and self.types == other.types
+                and self.counts == other.counts
+                and [self.strings[i] for i in self.texts]
+                    == [other.strings[i] for i in other.texts])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.toStringTree())
+
+    def __repr__(self):
+        return ('<{0.__module__}.{0.__name__} instance {1}>'
+                .format(self.__class__, self.toStringTree()))
+
+    def __str__(self):
+        return self.toStringTree()
+
+    def text(self, i):
+        """ Returns the text of the node at preorder position i. """
+        return self.strings[self.texts[i]]
+
+    def nodes(self):
+        """ Yields (type, text, number of children) for each node
+            in preorder. """
+        strings = self.strings
+        for t, c, x in zip(self.types, self.counts, self.texts):
+            yield t, strings[x], c
+
+    def ends(self):
+        """ Returns a list whose ith element is the preorder position just
+            past the end of the subtree rooted at position i. """
+        n = len(self)
+        counts = self.counts
+        ends = [0] * n
+        # Positions whose subtrees are still open, with children remaining.
+        stack = []
+        for i in range(n):
+            if counts[i]:
+                stack.append([i, counts[i]])
+            else:
+                ends[i] = i + 1
+                while stack:
+                    stack[-1][1] -= 1
+                    if stack[-1][1]:
+                        break
+                    ends[stack.pop()[0]] = i + 1
+        return ends
+
+    def toStringTree(self):
+        """ Returns the same string as CommonTree.toStringTree would for
+            the original tree. """
+        out = []
+        # [whether the node is non-nil, children done, number of children]
+        stack = []
+        for t, text, c in self.nodes():
+            if stack and stack[-1][1]:
+                out.append(' ')
+            if c:
+                if text is NIL:
+                    stack.append([False, 0, c])
+                else:
+                    out.append('(' + text + ' ')
+                    stack.append([True, 0, c])
+                continue
+            out.append('nil' if text is NIL else str(text))
+            while stack:
+                stack[-1][1] += 1
+                if stack[-1][1] < stack[-1][2]:
+                    break
+                if stack.pop()[0]:
+                    out.append(')')
+        return ''.join(out)
+
+    def to_tree(self):
+        """ Returns the tree as CommonTree objects. Error nodes become
+            plain nodes of the invalid token type with the error text. """
+        import antlr3.tree
+        root = None
+        # [node, children remaining]
+        stack = []
+        for t, text, c in self.nodes():
+            if text is NIL:
+                node = antlr3.tree.CommonTree(None)
+            else:
+                node = antlr3.tree.CommonTree(
+                        antlr3.CommonToken(type=t, text=text))
+            if stack:
+                stack[-1][0].addChild(node)
+                stack[-1][1] -= 1
+            else:
+                root = node
+            if c:
+                stack.append([node, c])
+            while stack and not stack[-1][1]:
+                stack.pop()
+        return root
+
+pack = PackedTree.pack
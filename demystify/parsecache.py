@@ -0,0 +1,153 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""parsecache -- A cache of parse trees by token template.
+
+Many fragments differ only in their numbers, mana symbols or names, eg.
+"{3}, {t}" and "{5}, {t}". After lexing, the text of each token of a
+placeholder type (eg. NUMBER_SYM) is replaced by a hole, and the rule and
+the resulting sequence of tokens form the template. The cache keeps one
+tree per template, with the nodes made from placeholder tokens as holes,
+and fills in the holes from the tokens of each new fragment.
+
+A template is only cached once it is shown to be safe: the fragment is
+parsed again with different text in every placeholder token, and the tree
+must be the first tree with the new text in its holes. A template where the
+texts are copied elsewhere in the tree, or change how the fragment parses,
+is remembered as unsafe and always goes to the parser.
+Since that check costs a second parse, and most templates are only ever
+seen once, a template with holes is only checked the second time it is
+parsed.
+"""
+
+import antlr3
+
+from packedtree import NIL, PackedTree
+
+class TemplateCache(object):
+    """ Parse trees by (rule, template). Only error-free parses are added. """
+    def __init__(self, placeholder_types):
+        """ placeholder_types: The token types whose text becomes a hole,
+            eg. [DemystifyParser.NUMBER_SYM, DemystifyParser.MANA_SYM]. """
+        self.placeholder_types = frozenset(placeholder_types)
+        # (rule, template) -> list of (type, number of children, text or
+        # placeholder index) in preorder, or None if the template is unsafe
+        self.templates = {}
+        # (rule, template) of the templates with holes parsed once so far
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.unsafe = 0
+
+    def __len__(self):
+        return len(self.templates)
+
+    def _template(self, rule, tokens):
+        """ Returns the key for the tokens and the placeholder tokens. """
+        ph = self.placeholder_types
+        key = [rule]
+        holes = []
+        for t in tokens:
+            if t.channel != antlr3.DEFAULT_CHANNEL:
+                continue
+            if t.type in ph:
+                key.append(t.type)
+                holes.append(t)
+            else:
+                key.append((t.type, t.text))
+        return tuple(key), holes
+
+    def get(self, rule, tokens):
+        """ Returns the PackedTree for a fragment lexed into the given
+            tokens, or None if its template isn't cached as safe. """
+        key, holes = self._template(rule, tokens)
+        nodes = self.templates.get(key)
+        if nodes is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _fill(nodes, [t.text for t in holes])
+
+    def add(self, rule, tokens, tree, reparse):
+        """ Adds the tree that the fragment with the given tokens parsed
+            into, if its template is safe and has been parsed before (or
+            has no holes). Returns whether it was added.
+
+            tree: The antlr3 tree, which must have been built from these
+                very tokens, without errors.
+            reparse: A function taking a list of tokens and returning a
+                pair (antlr3 tree, number of errors), used to check the
+                template. """
+        key, holes = self._template(rule, tokens)
+        if key in self.templates:
+            return self.templates[key] is not None
+        if holes and key not in self.seen:
+            self.seen.add(key)
+            return False
+        self.seen.discard(key)
+        index = {id(t): i for i, t in enumerate(holes)}
+        nodes = _template_nodes(tree, index)
+        # With no holes, the same tokens always give the same tree.
+        safe = True
+        if holes:
+            probes = ['#{}'.format(i) for i in range(len(holes))]
+            ptree, errors = reparse(_substitute(tokens, index, probes))
+            safe = (not errors
+                    and PackedTree.pack(ptree) == _fill(nodes, probes))
+        if not safe:
+            self.unsafe += 1
+            nodes = None
+        self.templates[key] = nodes
+        return safe
+
+def _template_nodes(tree, index):
+    """ Returns the nodes of tree in preorder, as in PackedTree.pack, with
+        the text of each node made from a placeholder token replaced by its
+        index in the list of placeholder tokens. """
+    nodes = []
+    stack = [tree]
+    while stack:
+        n = stack.pop()
+        children = n.children
+        if n.isNil():
+            text = NIL
+        elif id(getattr(n, 'token', None)) in index:
+            text = index[id(n.token)]
+        else:
+            text = n.toString()
+        nodes.append((n.getType(), len(children), text))
+        stack.extend(reversed(children))
+    return nodes
+
+def _fill(nodes, values):
+    """ Returns a PackedTree of the template nodes with the holes filled in
+        from values. """
+    return PackedTree.from_nodes(
+            (t, c, values[text] if isinstance(text, int) else text)
+            for t, c, text in nodes)
+
+def _substitute(tokens, index, values):
+    """ Returns copies of the tokens with the placeholder tokens' text
+        replaced by values. """
+    result = []
+    for t in tokens:
+        u = antlr3.CommonToken(oldToken=t)
+        i = index.get(id(t))
+        u.text = t.text if i is None else values[i]
+        result.append(u)
+    return result
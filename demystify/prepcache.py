@@ -0,0 +1,129 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""prepcache -- On-disk cache of preprocessed card text.
+
+Entries are keyed by card name, shortname, a hash of the card's original
+text and card.PREPROCESS_VERSION. Since the result also depends on which
+names are known (see card.preprocess_names), each entry records the names
+its card refers to and whether each was known, and is only used if that
+is still the case.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import card
+import data
+
+CACHEFILE = os.path.join(data.DATADIR, "cache", "preprocess.db")
+
+_schema = """
+CREATE TABLE IF NOT EXISTS preprocessed (
+    name TEXT PRIMARY KEY,
+    shortname TEXT,
+    hash TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    rules TEXT NOT NULL,
+    refs TEXT NOT NULL,
+    tokens TEXT NOT NULL
+);
+"""
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class PreprocessCache(object):
+    """ A SQLite database of preprocessed rules text, one entry per card. """
+    def __init__(self, filename=CACHEFILE):
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(_schema)
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def entry(self, c):
+        """ Returns (rules, refs, tokens) for the card if the cache has an
+            entry for its current text, whether or not the names it refers
+            to are still known as they were, or None.
+
+            refs: A list of (name, known) for every name the card's text
+                refers to, where known is whether it was a known name.
+            tokens: The token names found while preprocessing the card. """
+        row = self.db.execute(
+                'SELECT shortname, hash, version, rules, refs, tokens '
+                'FROM preprocessed WHERE name = ?', (c.name,)).fetchone()
+        if (row is None or row[0] != c.shortname
+                or row[1] != text_hash(c.raw_rules)
+                or row[2] != card.PREPROCESS_VERSION):
+            return None
+        return row[3], json.loads(row[4]), json.loads(row[5])
+
+    def get(self, c):
+        """ Returns (rules, refs, tokens) for the card, as in entry(), if
+            the cache has an entry that is still valid, or None. """
+        entry = self.entry(c)
+        if entry is None or any((name in card.all_names) != known
+                                for name, known in entry[1]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def add(self, c, rules, refs, tokens):
+        """ Adds or replaces the card's entry. It is written on the next
+            flush(). """
+        self.pending.append((c.name, c.shortname, text_hash(c.raw_rules),
+                             card.PREPROCESS_VERSION, rules,
+                             json.dumps(sorted(refs)),
+                             json.dumps(sorted(tokens))))
+
+    def flush(self):
+        """ Writes the added entries in a single transaction. """
+        if self.pending:
+            with self.db:
+                self.db.executemany(
+                        'INSERT OR REPLACE INTO preprocessed (name, '
+                        'shortname, hash, version, rules, refs, tokens) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending)
+            self.pending = []
+
+    def compact(self, names):
+        """ Drops the entries for cards not in names, and entries made by
+            other preprocessing versions, then reclaims the space. """
+        self.flush()
+        names = set(names)
+        stale = [(n,) for n, v in self.db.execute(
+                     'SELECT name, version FROM preprocessed')
+                 if n not in names or v != card.PREPROCESS_VERSION]
+        if stale:
+            with self.db:
+                self.db.executemany('DELETE FROM preprocessed WHERE name = ?',
+                                    stale)
+            self.db.execute('VACUUM')
+        return len(stale)
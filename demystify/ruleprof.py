@@ -0,0 +1,209 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""ruleprof -- Per-rule profiling of the generated Demystify parser."""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'deps'))
+import deps
+
+_grammar_dir = os.path.join(os.path.dirname(__file__), 'grammar')
+
+# Indices into the per-rule stats lists.
+CALLS, BT_CALLS, TOKENS, SYNPREDS, PREDICTS, CUMTIME, SELFTIME = range(7)
+COLUMNS = ('calls', 'bt_calls', 'tokens', 'synpreds', 'predicts',
+           'cumtime', 'selftime')
+
+_RULE, _SYNPRED, _PREDICT = range(1, 4)
+
+_rule_names = None
+
+def rule_names():
+    """ Returns the set of parser rule names defined in the grammar. """
+    global _rule_names
+    if _rule_names is None:
+        gfiles = [f for f in os.listdir(_grammar_dir)
+                  if os.path.splitext(f)[1] == '.g']
+        _rule_names = set(deps.read_rules(_grammar_dir, gfiles)[0])
+    return _rule_names
+
+class RuleProfiler(object):
+    """ Records, for each parser rule: the number of invocations, how many
+        of those happened while backtracking, tokens consumed, syntactic
+        predicates and DFA predictions evaluated within it, and cumulative
+        and self time. Also records self time per rule invocation stack,
+        for flame graphs.
+
+        Only the thread that calls start() is profiled. Profilers from
+        other processes can be combined with merge(other.data()). """
+    def __init__(self):
+        # rule name -> list of stats, indexed as COLUMNS
+        self.stats = {}
+        # 'rule;rule;rule' -> self time
+        self.stacks = {}
+        self._rules = rule_names()
+        # code object -> kind of function, or None
+        self._kinds = {}
+        # entries are [frame, rule name, start time, child time,
+        #              start token index, stack key]
+        self._stack = []
+        self._active = {}
+
+    def _kind(self, frame):
+        code = frame.f_code
+        try:
+            return self._kinds[code]
+        except KeyError:
+            pass
+        kind = None
+        modname = frame.f_globals.get('__name__', '')
+        name = code.co_name
+        if modname.startswith('grammar') and 'Parser' in modname:
+            if name in self._rules:
+                kind = _RULE
+            elif (name.startswith('synpred')
+                  and not name.endswith('fragment')):
+                kind = _SYNPRED
+        elif modname == 'antlr3.dfa' and name == 'predict':
+            kind = _PREDICT
+        self._kinds[code] = kind
+        return kind
+
+    def _rule_stats(self, rname):
+        s = self.stats.get(rname)
+        if s is None:
+            s = self.stats[rname] = [0, 0, 0, 0, 0, 0.0, 0.0]
+        return s
+
+    def _profile(self, frame, event, arg):
+        if event == 'call':
+            kind = self._kind(frame)
+            if not kind:
+                return
+            stack = self._stack
+            if kind == _RULE:
+                name = frame.f_code.co_name
+                # The top-level parser forwards imported rules to its
+                # delegates; count those as a single invocation.
+                if (stack and stack[-1][1] == name
+                        and stack[-1][0].f_globals is not frame.f_globals):
+                    return
+                recognizer = frame.f_locals.get('self')
+                s = self._rule_stats(name)
+                s[CALLS] += 1
+                try:
+                    if recognizer._state.backtracking:
+                        s[BT_CALLS] += 1
+                    index = recognizer.input.index()
+                except AttributeError:
+                    index = None
+                key = stack and stack[-1][5] + ';' + name or name
+                stack.append([frame, name, time.perf_counter(), 0.0,
+                              index, key])
+                self._active[name] = self._active.get(name, 0) + 1
+            elif stack:
+                s = self._rule_stats(stack[-1][1])
+                s[kind == _SYNPRED and SYNPREDS or PREDICTS] += 1
+        elif event == 'return':
+            stack = self._stack
+            if not stack or stack[-1][0] is not frame:
+                return
+            f, name, start, child, index, key = stack.pop()
+            elapsed = time.perf_counter() - start
+            s = self.stats[name]
+            self._active[name] -= 1
+            # Don't count recursive invocations twice.
+            if not self._active[name]:
+                s[CUMTIME] += elapsed
+            s[SELFTIME] += elapsed - child
+            self.stacks[key] = self.stacks.get(key, 0.0) + elapsed - child
+            if index is not None:
+                try:
+                    s[TOKENS] += f.f_locals['self'].input.index() - index
+                except (AttributeError, KeyError):
+                    pass
+            if stack:
+                stack[-1][3] += elapsed
+
+    def start(self):
+        sys.setprofile(self._profile)
+
+    def stop(self):
+        sys.setprofile(None)
+        self._stack = []
+        self._active = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def data(self):
+        """ Returns the collected data in a pickleable form. """
+        return (self.stats, self.stacks)
+
+    def merge(self, data):
+        """ Adds in data from another profiler's data(). """
+        if not data:
+            return
+        stats, stacks = data
+        for rname, s in stats.items():
+            t = self._rule_stats(rname)
+            for i, v in enumerate(s):
+                t[i] += v
+        for key, v in stacks.items():
+            self.stacks[key] = self.stacks.get(key, 0.0) + v
+
+    def report(self, sort='selftime', limit=None, out=None):
+        """ Prints a table of per-rule stats, sorted in descending order
+            by the given column. """
+        if out is None:
+            out = sys.stdout
+        col = COLUMNS.index(sort)
+        rows = sorted(self.stats.items(), key=lambda x: -x[1][col])
+        if limit:
+            rows = rows[:limit]
+        width = max([len(r) for r, _ in rows] + [4])
+        out.write('{:{w}} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10} {:>10}\n'
+                  .format('rule', *COLUMNS, w=width))
+        for rname, s in rows:
+            out.write('{:{w}} {:8d} {:8d} {:8d} {:8d} {:8d} {:10.4f} '
+                      '{:10.4f}\n'.format(rname, *s, w=width))
+
+    def write_report(self, filename):
+        """ Writes per-rule stats as tab-separated values with a header,
+            for sorting with other tools. """
+        with open(filename, 'w') as f:
+            f.write('\t'.join(('rule',) + COLUMNS) + '\n')
+            for rname, s in sorted(self.stats.items()):
+                f.write('\t'.join([rname] + [str(v) for v in s]) + '\n')
+
+    def write_collapsed(self, filename):
+        """ Writes self time per rule stack, in microseconds, in the
+            collapsed stack format used by flamegraph.pl. """
+        with open(filename, 'w') as f:
+            for key, v in sorted(self.stacks.items()):
+                us = int(v * 1000000)
+                if us:
+                    f.write('{} {}\n'.format(key, us))
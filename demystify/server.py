@@ -0,0 +1,186 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""server -- A long-running local server for Demystify requests.
+
+Requests are JSON objects of the form
+    {"id": any, "op": "parse", "args": {...}}
+and each gets a response of the form
+    {"id": any, "result": ...} or {"id": any, "error": "message"}.
+A JSON list of requests is a batch, and gets a list of responses.
+
+Over a Unix socket (--socket), each request or batch is one line, and each
+response is one line. Over TCP (--port), requests and batches are the bodies
+of HTTP POST requests to any path, and responses are the bodies of the
+HTTP responses.
+
+The ops are provided by the caller, and are run in a pool of worker
+processes forked after the corpus is loaded, so each worker starts warm.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+
+slog = logging.getLogger("Server")
+slog.setLevel(logging.INFO)
+
+_reasons = {200: 'OK', 400: 'Bad Request', 405: 'Method Not Allowed',
+            411: 'Length Required'}
+
+class ParseServer(object):
+    """ Dispatches requests to handlers, each of which is a pickleable
+        function taking the request's args as keyword arguments and
+        returning a JSON-serializable result. """
+    def __init__(self, handlers, workers=None, initializer=None):
+        self.handlers = handlers
+        self.workers = workers or os.cpu_count()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=initializer)
+
+    def warm(self):
+        """ Starts every worker process now rather than on first use. """
+        futures = [self.pool.submit(int) for _ in range(self.workers)]
+        concurrent.futures.wait(futures)
+
+    async def run_request(self, req):
+        if not isinstance(req, dict):
+            return {'error': 'Request must be a JSON object.'}
+        res = {'id': req.get('id')}
+        func = self.handlers.get(req.get('op'))
+        if not func:
+            res['error'] = 'Unknown op: {!r}'.format(req.get('op'))
+            return res
+        args = req.get('args') or {}
+        loop = asyncio.get_running_loop()
+        try:
+            res['result'] = await loop.run_in_executor(
+                    self.pool, functools.partial(func, **args))
+        except Exception as e:
+            slog.exception('Error handling {}'.format(req))
+            res['error'] = '{}: {}'.format(type(e).__name__, e)
+        return res
+
+    async def handle(self, body):
+        """ Returns the encoded response to an encoded request or batch. """
+        try:
+            req = json.loads(body)
+        except ValueError as e:
+            res = {'error': 'Malformed JSON: {}'.format(e)}
+        else:
+            if isinstance(req, list):
+                res = await asyncio.gather(*map(self.run_request, req))
+            else:
+                res = await self.run_request(req)
+        return json.dumps(res).encode('utf-8')
+
+    async def handle_lines(self, reader, writer):
+        """ Serves JSON-lines requests on one connection. """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(await self.handle(line) + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle_http(self, reader, writer):
+        """ Serves HTTP POST requests on one connection. """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if not h.strip():
+                        break
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                method = request_line.split()[0]
+                if method != b'POST':
+                    await self._http_respond(writer, 405, b'')
+                elif 'content-length' not in headers:
+                    await self._http_respond(writer, 411, b'')
+                else:
+                    body = await reader.readexactly(
+                            int(headers['content-length']))
+                    await self._http_respond(writer, 200,
+                                             await self.handle(body))
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            await self._http_respond(writer, 400, str(e).encode('utf-8'))
+        finally:
+            writer.close()
+
+    async def _http_respond(self, writer, status, body):
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                     'Content-Length: {}\r\n\r\n'
+                     .format(status, _reasons[status], len(body))
+                     .encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, socket_path=None, port=None):
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_lines,
+                                                     path=socket_path)
+            print('Listening on {}.'.format(socket_path))
+        else:
+            server = await asyncio.start_server(self.handle_http,
+                                                host='127.0.0.1', port=port)
+            print('Listening on http://127.0.0.1:{}/.'.format(port))
+        async with server:
+            await server.serve_forever()
+
+def run(args, handlers, initializer=None):
+    """ Runs a server for the given handlers until interrupted. """
+    server = ParseServer(handlers, workers=args.workers,
+                         initializer=initializer)
+    server.warm()
+    try:
+        asyncio.run(server.serve(socket_path=args.socket, port=args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+def add_subcommands(subparsers, func):
+    """ Adds the 'serve' command to the main parser, which will call
+        func with the parsed args once the corpus is loaded. func should
+        run the server with run(). subparsers should be the object returned
+        by add_subparsers() called on the main parser. """
+    subparser = subparsers.add_parser('serve',
+        description='Serve parse and search requests with a warm parser.')
+    subparser.add_argument('--socket',
+        help='Unix socket path to serve JSON lines on.')
+    subparser.add_argument('--port', type=int, default=8765,
+        help='Local TCP port to serve HTTP on, if --socket is not given.')
+    subparser.add_argument('--workers', type=int,
+        help='Number of worker processes. Defaults to the number of CPUs.')
+    subparser.set_defaults(func=func)
@@ -0,0 +1,159 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""store -- Persistent storage of parse results in SQLite."""
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+
+import data
+from packedtree import PackedTree
+
+STOREFILE = os.path.join(data.DATADIR, "cache", "results.db")
+_grammar_dir = os.path.join(os.path.dirname(__file__), 'grammar')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    card TEXT NOT NULL,
+    pass TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    lineno INTEGER,
+    text TEXT NOT NULL,
+    tree TEXT NOT NULL,
+    packed BLOB NOT NULL,
+    strings TEXT NOT NULL,
+    errors INTEGER NOT NULL,
+    grammar TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_card ON results (card);
+CREATE INDEX IF NOT EXISTS results_rule ON results (rule);
+CREATE INDEX IF NOT EXISTS results_lineno ON results (lineno);
+CREATE INDEX IF NOT EXISTS results_errors ON results (errors > 0);
+CREATE INDEX IF NOT EXISTS results_grammar ON results (grammar, pass);
+"""
+
+# One stored parse result. tree is a PackedTree.
+StoredResult = collections.namedtuple(
+        'StoredResult', 'card pass_ rule lineno text tree errors grammar')
+
+_version = None
+
+def grammar_version():
+    """ Returns a short hash of the grammar files, identifying the
+        parser that produced a result. """
+    global _version
+    if _version is None:
+        h = hashlib.sha1()
+        for f in sorted(os.listdir(_grammar_dir)):
+            if os.path.splitext(f)[1] == '.g':
+                with open(os.path.join(_grammar_dir, f), 'rb') as g:
+                    h.update(f.encode('utf-8') + b'\0' + g.read())
+        _version = h.hexdigest()[:12]
+    return _version
+
+class ResultStore(object):
+    """ A SQLite database of parse results, indexed by card name, rule,
+        line number, whether there were errors, and grammar version. """
+    def __init__(self, filename=STOREFILE):
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def add_results(self, passname, rule, rows, cards=None, grammar=None):
+        """ Replaces the stored results of a parse pass for a grammar
+            version (by default, the current one) with the given rows,
+            in a single transaction. Only the results of the cards that
+            were parsed are replaced; other cards' results are kept.
+
+            passname: The name of the pass, eg. 'costs' or 'typeline'.
+            rule: The parser rule used.
+            rows: An iterable of (card name, lineno, text, PackedTree,
+                number of errors). lineno may be None.
+            cards: The names of the cards that were parsed, including
+                any that had nothing to parse for this pass. Defaults to
+                the cards in rows. """
+        grammar = grammar or grammar_version()
+        rows = list(rows)
+        if cards is None:
+            cards = {r[0] for r in rows}
+        with self.db:
+            self.db.executemany('DELETE FROM results WHERE grammar = ? '
+                                'AND pass = ? AND card = ?',
+                                ((grammar, passname, cname)
+                                 for cname in cards))
+            self.db.executemany(
+                'INSERT INTO results (card, pass, rule, lineno, text, tree, '
+                'packed, strings, errors, grammar) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((cname, passname, rule, lineno, text, t.toStringTree(),
+                  t.data, json.dumps(t.strings), errors, grammar)
+                 for cname, lineno, text, t, errors in rows))
+
+    def find(self, passname=None, rule=None, card=None, lineno=None,
+             errors=None, contains=None, grammar=None):
+        """ Returns a list of StoredResults matching all the given criteria.
+
+            errors: If True, only results with errors; if False, only
+                results without.
+            contains: Text that must appear in the tree's string form,
+                ignoring case, eg. '(ZONE_SET graveyard'.
+            grammar: The grammar version. Defaults to the current one;
+                use '*' for any version. """
+        grammar = grammar or grammar_version()
+        clauses = []
+        params = []
+        for col, val in (('pass', passname), ('rule', rule), ('card', card),
+                         ('lineno', lineno)):
+            if val is not None:
+                clauses.append('{} = ?'.format(col))
+                params.append(val)
+        if grammar != '*':
+            clauses.append('grammar = ?')
+            params.append(grammar)
+        if errors is not None:
+            clauses.append(errors and 'errors > 0' or 'errors = 0')
+        if contains:
+            clauses.append("tree LIKE ? ESCAPE '\\'")
+            params.append('%' + contains.replace('\\', '\\\\')
+                                        .replace('%', '\\%')
+                                        .replace('_', '\\_') + '%')
+        query = ('SELECT card, pass, rule, lineno, text, packed, strings, '
+                 'errors, grammar FROM results')
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY card, pass, lineno, id'
+        return [StoredResult(c, p, r, l, text,
+                             PackedTree(packed, tuple(json.loads(strings))),
+                             e, g)
+                for c, p, r, l, text, packed, strings, e, g
+                in self.db.execute(query, params)]
+
+    def cards(self, **kwargs):
+        """ Returns the sorted names of cards with results matching the
+            criteria of find(). """
+        return sorted({r.card for r in self.find(**kwargs)})
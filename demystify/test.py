@@ -22,13 +22,19 @@ import argparse
 import difflib
 import os
 import re
+import sys
 import unittest
 
 import antlr3
 
 from grammar import DemystifyLexer, DemystifyParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'deps'))
+import deps
+
 _rule_name = re.compile(r'\w+')
+_grammar_dir = os.path.join(os.path.dirname(__file__), 'grammar')
 
 class IgnoreCaseDiffer(difflib.Differ, object):
     """ Compares two string sequences but ignores case. """
@@ -200,7 +206,9 @@ def create_test_function(name, rule, text, expected):
         self.assertEqual(1, len(diff), differror + ''.join(diff))
     return test_function
 
-def create_test_case(filename):
+def create_test_case(filename, rules=None):
+    """ Creates a TestCase class out of the tests in the given file.
+        If rules is given, only tests of those rules are included. """
     fname = os.path.splitext(os.path.basename(filename))[0]
     canon_name = fname.replace('.', '_').capitalize()
     class TestCase(unittest.TestCase):
@@ -209,6 +217,8 @@ def create_test_case(filename):
     TestCase.__name__ = canon_name + 'TestCase'
     d = {}
     for name, rule, text, exp in generate_tests(filename):
+        if rules is not None and rule not in rules:
+            continue
         if name not in d:
             d[name] = 1
         else:
@@ -216,10 +226,38 @@ def create_test_case(filename):
         name = 'test_{}{}{}'.format(canon_name, name, d[name])
         setattr(TestCase, name, create_test_function(name, rule, text, exp))
     if not d:
-        print('No test cases generated for {}.'.format(filename))
+        if rules is None:
+            print('No test cases generated for {}.'.format(filename))
         return None
     return TestCase
 
+def affected_rules(changed, grammar_dir=_grammar_dir):
+    """ Returns the set of parser rules that transitively depend on
+        anything in changed, which is a list of grammar filenames and/or
+        parser rule names. Returns None if every rule may be affected,
+        eg. if a lexer grammar changed. """
+    gfiles = [f for f in os.listdir(grammar_dir)
+              if os.path.splitext(f)[1] == '.g']
+    rdeps, file_rules = deps.read_rules(grammar_dir, gfiles)
+    targets = set()
+    for c in changed:
+        f = os.path.basename(c)
+        if f in file_rules:
+            with open(os.path.join(grammar_dir, f)) as g:
+                header = g.readline()
+            # Token and header changes can affect any rule.
+            if not header.startswith('parser grammar'):
+                print('{} is not a parser grammar; selecting all tests.'
+                      .format(f))
+                return None
+            targets |= file_rules[f]
+        elif c in rdeps:
+            targets.add(c)
+        else:
+            print('Warning: {} is neither a grammar file nor a parser rule.'
+                  .format(c))
+    return deps.dependents(rdeps, targets)
+
 def add_subcommands(subparsers):
     """ Adds the 'test' command to the main parser.
         subparsers should be the object returned by add_subparsers()
@@ -231,6 +269,9 @@ def add_subcommands(subparsers):
     subparser.add_argument('--test_dir',
         default=os.path.join(os.path.dirname(__file__), 'tests'),
         help='Folder containing test cases.')
+    subparser.add_argument('-c', '--changed', nargs='+', metavar='RULE',
+        help=('Grammar files (eg. zones.g) or parser rules that changed. '
+              'Only tests of rules that depend on them will be run.'))
     subparser.add_argument('tests', nargs='*',
         help=('List of test files to run. If omitted, all .txt files '
               'in --test_dir will be run.'))
@@ -262,9 +303,18 @@ def run_tests(args):
     if not tests:
         print('No test files found, exiting.')
         return
-    test_cases = [create_test_case(filename) for filename in tests]
+    rules = None
+    if args.changed:
+        rules = affected_rules(args.changed)
+        if rules is not None:
+            print('Selected {} affected rules: {}'
+                  .format(len(rules), ' '.join(sorted(rules))))
+    test_cases = [create_test_case(filename, rules) for filename in tests]
     if not any(test_cases):
-        print('Error: No test cases generated.')
+        if rules is None:
+            print('Error: No test cases generated.')
+        else:
+            print('No test cases depend on the changed rules.')
         return
     for tc in test_cases:
         if tc:
@@ -0,0 +1,71 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the names that card.split_names records as referred to."""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir))
+import card
+
+def _card(name, text):
+    return card.Card(name=name, type_line='Sorcery', mana_cost='{1}',
+                     oracle_text=text)
+
+class SplitNamesRefsTest(unittest.TestCase):
+    def split(self, text, cardnames=()):
+        refs = set()
+        names = card.split_names(text.split(' '), cardnames, refs)
+        return names, refs
+
+    def test_single_word_with_punctuation(self):
+        for end in ':."':
+            names, refs = self.split('Kaldra' + end + ' Then shuffle.')
+            self.assertEqual(names, ('Kaldra',))
+            self.assertIn('Kaldra', refs)
+
+    def test_trailing_punctuation(self):
+        names, refs = self.split('Blade of the Nine Gates.')
+        self.assertEqual(names, ('Blade of the Nine Gates',))
+        self.assertIn('Blade of the Nine Gates', refs)
+
+    def test_repeated_self_name(self):
+        names, refs = self.split('Lim-Dul, Lim-Dul and more',
+                                 cardnames=('Lim-Dul',))
+        self.assertEqual(names, ('Lim-Dul',))
+        self.assertIn('Lim-Dul', refs)
+
+    def test_list_of_names(self):
+        names, refs = self.split('Kaldra and Other Thing.')
+        self.assertIn('Kaldra and Other Thing', refs)
+
+class AffectedCardsTest(unittest.TestCase):
+    def test_single_word_reference(self):
+        kaldra = _card('Testkaldra', 'Flying.')
+        seeker = _card('Testseeker', 'Search your library for a card named '
+                                     'Testkaldra.')
+        for c in (kaldra, seeker):
+            card.preprocess_card(c)
+        self.assertEqual(card.name_refs['Testseeker'], {'Testkaldra'})
+        self.assertIn(seeker, card.affected_cards(['Testkaldra']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""treequery -- Structural searches over parse trees.
+
+Patterns are written like the string form of a tree, eg.
+    (EVENT (SUBSET SELF) DIE)
+and match any subtree whose root has the given label and has children
+matching each child pattern, in order (other children may come between).
+A label matches a node if it is the node's text or token type name,
+ignoring case. The label * matches any node.
+"""
+
+import re
+
+WILDCARD = '*'
+
+_pattern_token = re.compile(r'\(|\)|[^\s()]+')
+
+class Pattern(object):
+    """ A node of a parsed tree pattern. """
+    def __init__(self, label, children=()):
+        self.label = label
+        self.children = list(children)
+
+    def __repr__(self):
+        if not self.children:
+            return self.label
+        return '({} {})'.format(self.label,
+                                ' '.join(map(repr, self.children)))
+
+    def labels(self):
+        """ Yields every non-wildcard label in the pattern. """
+        if self.label != WILDCARD:
+            yield self.label
+        for c in self.children:
+            yield from c.labels()
+
+    def pairs(self):
+        """ Yields every (parent label, child label) pair in the pattern
+            where neither is a wildcard. """
+        for c in self.children:
+            if self.label != WILDCARD and c.label != WILDCARD:
+                yield (self.label, c.label)
+            yield from c.pairs()
+
+def parse_pattern(text):
+    """ Returns the Pattern for a string like '(EVENT (SUBSET SELF) DIE)'.
+        Raises ValueError if it is malformed. """
+    tokens = _pattern_token.findall(text)
+    if not tokens:
+        raise ValueError('Empty pattern')
+    pos = 0
+    def _node():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError('Unexpected end of pattern: {}'.format(text))
+        t = tokens[pos]
+        pos += 1
+        if t == ')':
+            raise ValueError('Unexpected ) in pattern: {}'.format(text))
+        if t != '(':
+            return Pattern(t.upper())
+        if pos >= len(tokens) or tokens[pos] in '()':
+            raise ValueError('Expected a label after ( in pattern: {}'
+                             .format(text))
+        p = Pattern(tokens[pos].upper())
+        pos += 1
+        while pos < len(tokens) and tokens[pos] != ')':
+            p.children.append(_node())
+        if pos >= len(tokens):
+            raise ValueError('Missing ) in pattern: {}'.format(text))
+        pos += 1
+        return p
+    p = _node()
+    if pos != len(tokens):
+        raise ValueError('Trailing text in pattern: {}'.format(text))
+    return p
+
+class TreeIndex(object):
+    """ An index of PackedTrees by the labels of their nodes and by
+        (parent label, child label) pairs, so that a pattern search only
+        has to check the trees that contain every label and pair in it. """
+    def __init__(self, token_names=None):
+        """ token_names: A list of token type names, indexed by type,
+            eg. DemystifyParser.tokenNames. If not given, nodes are only
+            indexed by their text. """
+        self.token_names = token_names
+        self.keys = []
+        self.trees = []
+        # label -> set of tree ids
+        self.labels = {}
+        # (parent label, child label) -> set of tree ids
+        self.pairs = {}
+
+    def __len__(self):
+        return len(self.trees)
+
+    def _node_labels(self, tree):
+        """ Returns a list of the set of labels of each node in preorder. """
+        names = self.token_names
+        labels = []
+        for t, text, _ in tree.nodes():
+            ls = set()
+            if text is not None:
+                ls.add(text.upper())
+            if names and 0 <= t < len(names):
+                ls.add(names[t])
+            labels.append(ls)
+        return labels
+
+    def add(self, key, tree):
+        """ Adds a PackedTree to the index, to be found by the given key,
+            eg. (card name, pass name, line number). Returns its id. """
+        tid = len(self.trees)
+        self.keys.append(key)
+        self.trees.append(tree)
+        labels = self._node_labels(tree)
+        for ls in labels:
+            for l in ls:
+                self.labels.setdefault(l, set()).add(tid)
+        ends = tree.ends()
+        for i, ls in enumerate(labels):
+            j = i + 1
+            while j < ends[i]:
+                for l in ls:
+                    for m in labels[j]:
+                        self.pairs.setdefault((l, m), set()).add(tid)
+                j = ends[j]
+        return tid
+
+    def candidates(self, pattern):
+        """ Returns the set of ids of the trees that contain every label and
+            pair in the pattern, or None if the pattern is all wildcards. """
+        sets = ([self.labels.get(l, set()) for l in set(pattern.labels())]
+                + [self.pairs.get(p, set()) for p in set(pattern.pairs())])
+        if not sets:
+            return None
+        sets.sort(key=len)
+        result = set(sets[0])
+        for s in sets[1:]:
+            if not result:
+                break
+            result &= s
+        return result
+
+    def search(self, pattern):
+        """ Returns the keys of all trees with a subtree matching the
+            pattern, which is a Pattern or its string form. """
+        if isinstance(pattern, str):
+            pattern = parse_pattern(pattern)
+        tids = self.candidates(pattern)
+        if tids is None:
+            tids = range(len(self.trees))
+        return [self.keys[tid] for tid in sorted(tids)
+                if self.matches(self.trees[tid], pattern)]
+
+    def matches(self, tree, pattern):
+        """ Returns whether any subtree of tree matches pattern. """
+        labels = self._node_labels(tree)
+        ends = tree.ends()
+
+        def _match(p, i):
+            if p.label != WILDCARD and p.label not in labels[i]:
+                return False
+            return _match_children(p.children, 0, i + 1, ends[i])
+
+        def _match_children(pcs, k, j, end):
+            # Match pattern children pcs[k:] against the tree children
+            # starting at position j, in order.
+            if k == len(pcs):
+                return True
+            while j < end:
+                if (_match(pcs[k], j)
+                        and _match_children(pcs, k + 1, ends[j], end)):
+                    return True
+                j = ends[j]
+            return False
+
+        return any(_match(pattern, i) for i in range(len(labels)))
@@ -41,6 +41,38 @@ def find_rules(fulltext):
                 deps[rname].add(m.group(1))
     return deps
 
+def read_rules(basedir, filenames):
+    """ Reads the given grammar files in basedir. Returns a pair of dicts:
+        rule name -> set of rules it depends on, and
+        filename -> set of rule names defined in that file. """
+    deps = {}
+    file_rules = {}
+    for f in filenames:
+        with open(os.path.join(basedir, f)) as g:
+            fdeps = find_rules(g.read())
+        deps.update(fdeps)
+        file_rules[os.path.basename(f)] = set(fdeps)
+    return deps, file_rules
+
+def dependents(deps, targets):
+    """ Returns the set of rules that can reach any of the target rules,
+        including the targets themselves. """
+    rdeps = {}
+    for rname, rd in deps.items():
+        for d in rd:
+            if d not in rdeps:
+                rdeps[d] = {rname}
+            else:
+                rdeps[d].add(rname)
+    seen = set(targets)
+    stack = list(seen)
+    while stack:
+        for rname in rdeps.get(stack.pop(), ()):
+            if rname not in seen:
+                seen.add(rname)
+                stack.append(rname)
+    return seen
+
 def print_deps(deps, indent_level=1):
     indent = '  ' * indent_level
     for rname, rdeps in deps.items():